@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Claude Code Plus proxy.
+
+The proxy app is driven in-process through httpx's ASGI transport and the
+upstream LiteLLM call is replaced with a fake that sleeps for a fixed latency,
+so no API keys or network access are needed.
+
+Usage:
+  python bench.py                          # Run all benchmarks
+  python bench.py concurrency              # Run a single benchmark
+  python bench.py concurrency -n 50 --latency 0.5
+  python bench.py priority -n 40 --latency 0.2
+  python bench.py conversion --turns 200
+  python bench.py tools
+  python bench.py converter --history-mb 1
+  python bench.py json
+"""
+
+import gc
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import tracemalloc
+
+# The server refuses to import without keys; the fake upstream never uses them
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import httpx
+import litellm
+
+from src.ccp import server
+
+# Keep the per-request console log out of the benchmark output
+server.log_request_beautifully = lambda *args, **kwargs: None
+
+PROXY_URL = "http://proxy"
+
+SIMPLE_REQUEST = {
+    "model": "claude-3-sonnet-20240229",
+    "max_tokens": 300,
+    "messages": [
+        {"role": "user", "content": "Hello, world! Can you tell me about Paris in 2-3 sentences?"}
+    ]
+}
+
+# ================= FAKE UPSTREAM =================
+
+def make_model_response(model, text="Paris is the capital of France."):
+    """Build a LiteLLM ModelResponse like the one a real provider would return."""
+    return litellm.ModelResponse(
+        id=f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        model=model,
+        choices=[{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": text},
+        }],
+        usage={"prompt_tokens": 20, "completion_tokens": 8, "total_tokens": 28},
+    )
+
+def fake_acompletion(latency, blocking=False):
+    """Return a stand-in for litellm.acompletion with a fixed upstream latency.
+
+    With blocking=True the fake sleeps synchronously, which is what calling the
+    sync litellm.completion from an async handler used to do to the event loop.
+    """
+    async def acompletion(**kwargs):
+        if blocking:
+            time.sleep(latency)
+        else:
+            await asyncio.sleep(latency)
+        return make_model_response(kwargs.get("model"))
+    return acompletion
+
+def proxy_client():
+    """Create an HTTP client bound directly to the proxy ASGI app."""
+    transport = httpx.ASGITransport(app=server.app)
+    return httpx.AsyncClient(transport=transport, base_url=PROXY_URL, timeout=None)
+
+# ================= PREVIOUS CONVERTER =================
+# The message converters as they were before OpenAI messages were converted in a single pass,
+# kept as the baseline for the converter benchmark
+
+def previous_convert_message(msg, carry_cache_control):
+    """convert_message before the single-pass rewrite: blocks built first, tool results joined with +=."""
+    content = msg.content
+    if isinstance(content, str):
+        return {"role": msg.role, "content": content}
+    else:
+        # Special handling for tool_result in user messages
+        # OpenAI/LiteLLM format expects the assistant to call the tool, 
+        # and the user's next message to include the result as plain text
+        if msg.role == "user" and any(block.type == "tool_result" for block in content if hasattr(block, "type")):
+            # For user messages with tool_result, split into separate messages
+            text_content = ""
+    
+            # Extract all text parts and concatenate them
+            for block in content:
+                if hasattr(block, "type"):
+                    if block.type == "text":
+                        text_content += block.text + "\n"
+                    elif block.type == "tool_result":
+                        # Add tool result as a message by itself - simulate the normal flow
+                        tool_id = block.tool_use_id if hasattr(block, "tool_use_id") else ""
+    
+                        # Handle different formats of tool result content
+                        result_content = ""
+                        if hasattr(block, "content"):
+                            if isinstance(block.content, str):
+                                result_content = block.content
+                            elif isinstance(block.content, list):
+                                # If content is a list of blocks, extract text from each
+                                for content_block in block.content:
+                                    if hasattr(content_block, "type") and content_block.type == "text":
+                                        result_content += content_block.text + "\n"
+                                    elif isinstance(content_block, dict) and content_block.get("type") == "text":
+                                        result_content += content_block.get("text", "") + "\n"
+                                    elif isinstance(content_block, dict):
+                                        # Handle any dict by trying to extract text or convert to JSON
+                                        if "text" in content_block:
+                                            result_content += content_block.get("text", "") + "\n"
+                                        else:
+                                            try:
+                                                result_content += server.canonical_json(content_block) + "\n"
+                                            except:
+                                                result_content += str(content_block) + "\n"
+                            elif isinstance(block.content, dict):
+                                # Handle dictionary content
+                                if block.content.get("type") == "text":
+                                    result_content = block.content.get("text", "")
+                                else:
+                                    try:
+                                        result_content = server.canonical_json(block.content)
+                                    except:
+                                        result_content = str(block.content)
+                            else:
+                                # Handle any other type by converting to string
+                                try:
+                                    result_content = str(block.content)
+                                except:
+                                    result_content = "Unparseable content"
+    
+                        # In OpenAI format, tool results come from the user (rather than being content blocks)
+                        text_content += f"Tool result for {tool_id}:\n{result_content}\n"
+    
+            # Add as a single user message with all the content
+            markers = [block.cache_control for block in content if getattr(block, "cache_control", None)]
+            if carry_cache_control and markers:
+                # Claude Code marks the newest tool result; keep that breakpoint on the flattened text
+                return {"role": "user", "content": [
+                    {"type": "text", "text": text_content.strip(), "cache_control": markers[-1]}
+                ]}
+            else:
+                return {"role": "user", "content": text_content.strip()}
+        else:
+            # Regular handling for other message types
+            processed_content = []
+            for block in content:
+                if hasattr(block, "type"):
+                    if block.type == "text":
+                        processed_content.append({"type": "text", "text": block.text})
+                    elif block.type == "image":
+                        processed_content.append({"type": "image", "source": block.source})
+                    elif block.type == "tool_use":
+                        # Handle tool use blocks if needed
+                        processed_content.append({
+                            "type": "tool_use",
+                            "id": block.id,
+                            "name": block.name,
+                            "input": server.canonical_value(block.input)
+                        })
+                    elif block.type == "tool_result":
+                        # Handle different formats of tool result content
+                        processed_content_block = {
+                            "type": "tool_result",
+                            "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
+                        }
+    
+                        # Process the content field properly
+                        if hasattr(block, "content"):
+                            if isinstance(block.content, str):
+                                # If it's a simple string, create a text block for it
+                                processed_content_block["content"] = [{"type": "text", "text": block.content}]
+                            elif isinstance(block.content, list):
+                                # If it's already a list of blocks, keep it
+                                processed_content_block["content"] = server.canonical_value(block.content)
+                            else:
+                                # Default fallback
+                                processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
+                        else:
+                            # Default empty content
+                            processed_content_block["content"] = [{"type": "text", "text": ""}]
+    
+                        processed_content.append(processed_content_block)
+    
+                    if carry_cache_control and processed_content and block.cache_control:
+                        server.with_cache_control(processed_content[-1], block)
+    
+            return {"role": msg.role, "content": processed_content}
+
+def previous_flatten_openai_message(msg):
+    """Reduce a converted message to what OpenAI models accept: string content and standard fields only."""
+    # Special case - handle message content directly when it's a list of tool_result
+    # This is a specific case we're seeing in the error
+    if "content" in msg and isinstance(msg["content"], list):
+        is_only_tool_result = True
+        for block in msg["content"]:
+            if not isinstance(block, dict) or block.get("type") != "tool_result":
+                is_only_tool_result = False
+                break
+
+        if is_only_tool_result and len(msg["content"]) > 0:
+            server.logger.warning(f"Found message with only tool_result content - special handling required")
+            # Extract the content from all tool_result blocks
+            all_text = ""
+            for block in msg["content"]:
+                all_text += "Tool Result:\n"
+                result_content = block.get("content", [])
+
+                # Handle different formats of content
+                if isinstance(result_content, list):
+                    for item in result_content:
+                        if isinstance(item, dict) and item.get("type") == "text":
+                            all_text += item.get("text", "") + "\n"
+                        elif isinstance(item, dict):
+                            # Fall back to string representation of any dict
+                            try:
+                                item_text = item.get("text", server.canonical_json(item))
+                                all_text += item_text + "\n"
+                            except:
+                                all_text += str(item) + "\n"
+                elif isinstance(result_content, str):
+                    all_text += result_content + "\n"
+                else:
+                    try:
+                        all_text += server.canonical_json(result_content) + "\n"
+                    except:
+                        all_text += str(result_content) + "\n"
+
+            # Replace the list with extracted text
+            msg["content"] = all_text.strip() or "..."
+            server.logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
+            return msg  # Skip normal processing for this message
+
+    # 1. Handle content field - normal case
+    if "content" in msg:
+        # Check if content is a list (content blocks)
+        if isinstance(msg["content"], list):
+            # Convert complex content blocks to simple string
+            text_content = ""
+            for block in msg["content"]:
+                if isinstance(block, dict):
+                    # Handle different content block types
+                    if block.get("type") == "text":
+                        text_content += block.get("text", "") + "\n"
+
+                    # Handle tool_result content blocks - extract nested text
+                    elif block.get("type") == "tool_result":
+                        tool_id = block.get("tool_use_id", "unknown")
+                        text_content += f"[Tool Result ID: {tool_id}]\n"
+
+                        # Extract text from the tool_result content
+                        result_content = block.get("content", [])
+                        if isinstance(result_content, list):
+                            for item in result_content:
+                                if isinstance(item, dict) and item.get("type") == "text":
+                                    text_content += item.get("text", "") + "\n"
+                                elif isinstance(item, dict):
+                                    # Handle any dict by trying to extract text or convert to JSON
+                                    if "text" in item:
+                                        text_content += item.get("text", "") + "\n"
+                                    else:
+                                        try:
+                                            text_content += server.canonical_json(item) + "\n"
+                                        except:
+                                            text_content += str(item) + "\n"
+                        elif isinstance(result_content, dict):
+                            # Handle dictionary content
+                            if result_content.get("type") == "text":
+                                text_content += result_content.get("text", "") + "\n"
+                            else:
+                                try:
+                                    text_content += server.canonical_json(result_content) + "\n"
+                                except:
+                                    text_content += str(result_content) + "\n"
+                        elif isinstance(result_content, str):
+                            text_content += result_content + "\n"
+                        else:
+                            try:
+                                text_content += server.canonical_json(result_content) + "\n"
+                            except:
+                                text_content += str(result_content) + "\n"
+
+                    # Handle tool_use content blocks
+                    elif block.get("type") == "tool_use":
+                        tool_name = block.get("name", "unknown")
+                        tool_id = block.get("id", "unknown")
+                        tool_input = server.canonical_json(block.get("input", {}))
+                        text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
+
+                    # Handle image content blocks
+                    elif block.get("type") == "image":
+                        text_content += "[Image content - not displayed in text format]\n"
+
+            # Make sure content is never empty for OpenAI models
+            if not text_content.strip():
+                text_content = "..."
+
+            msg["content"] = text_content.strip()
+        # Also check for None or empty string content
+        elif msg["content"] is None:
+            msg["content"] = "..." # Empty content not allowed
+
+    # 2. Remove any fields OpenAI doesn't support in messages
+    for key in list(msg.keys()):
+        if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
+            server.logger.warning(f"Removing unsupported field from message: {key}")
+            del msg[key]
+
+    # 3. Final validation - check for any remaining invalid values and dump full message details
+    # Log the message format for debugging
+    server.logger.debug(f"Message format check - role: {msg.get('role')}, content type: {type(msg.get('content'))}")
+
+    # If content is still a list or None, replace with placeholder
+    if isinstance(msg.get("content"), list):
+        server.logger.warning(f"CRITICAL: Message still has list content after processing: {json.dumps(msg.get('content'))}")
+        # Last resort - stringify the entire content as JSON
+        msg["content"] = f"Content as JSON: {server.canonical_json(msg.get('content'))}"
+    elif msg.get("content") is None:
+        server.logger.warning(f"Message has None content - replacing with placeholder")
+        msg["content"] = "..." # Fallback placeholder
+
+    return msg
+
+def previous_convert_openai_message(msg, carry_cache_control):
+    """The previous OpenAI path: the block conversion, then a second pass flattening it to a string."""
+    return previous_flatten_openai_message(previous_convert_message(msg, carry_cache_control))
+
+# ================= BENCHMARKS =================
+
+async def run_concurrent(client, requests):
+    """Fire all requests at once and return the wall-clock time."""
+    start_time = time.time()
+    responses = await asyncio.gather(*[
+        client.post("/v1/messages", json=request_data) for request_data in requests
+    ])
+    elapsed = time.time() - start_time
+    failures = [r.status_code for r in responses if r.status_code != 200]
+    if failures:
+        print(f"  ⚠️ {len(failures)} requests failed: {failures[:5]}")
+    return elapsed
+
+async def bench_concurrency(args):
+    """N concurrent non-streaming requests should take ~1 upstream latency, not N."""
+    original = server.litellm.acompletion
+    results = {}
+    # Distinct prompts, so identical-request coalescing does not merge them into one upstream call
+    requests = [
+        {**SIMPLE_REQUEST, "messages": [{"role": "user", "content": f"Tell me about city {i} in 2-3 sentences."}]}
+        for i in range(args.requests)
+    ]
+    try:
+        async with proxy_client() as client:
+            for label, blocking in (("blocking upstream call", True), ("async upstream call", False)):
+                server.litellm.acompletion = fake_acompletion(args.latency, blocking=blocking)
+                elapsed = await run_concurrent(client, requests)
+                results[label] = elapsed
+                print(f"  {label:<24} {args.requests} requests in {elapsed:.2f}s "
+                      f"({elapsed / args.latency:.1f}x upstream latency)")
+    finally:
+        server.litellm.acompletion = original
+    return results
+
+async def timed_post(client, request_data):
+    start_time = time.time()
+    response = await client.post("/v1/messages", json=request_data)
+    return response.status_code, time.time() - start_time
+
+async def bench_priority(args):
+    """Under a saturated provider limit, interactive sonnet turns should wait less than background haiku calls."""
+    original = server.litellm.acompletion
+    original_limits = dict(server.admission.provider_limits)
+    server.litellm.acompletion = fake_acompletion(args.latency)
+    server.admission.provider_limits["openai"] = 2
+    server.admission.limiters.clear()
+    try:
+        async with proxy_client() as client:
+            # Distinct prompts, so identical-request coalescing does not merge them
+            background = [
+                {**SIMPLE_REQUEST, "model": "claude-3-haiku-20240307",
+                 "messages": [{"role": "user", "content": f"Summarize topic {i}"}]}
+                for i in range(args.requests)
+            ]
+            interactive = [
+                {**SIMPLE_REQUEST, "tools": [{"name": "Read", "input_schema": {"type": "object"}}],
+                 "messages": [{"role": "user", "content": f"Edit file {i}"}]}
+                for i in range(max(1, args.requests // 4))
+            ]
+            results = await asyncio.gather(*[timed_post(client, data) for data in background + interactive])
+    finally:
+        server.litellm.acompletion = original
+        server.admission.provider_limits = original_limits
+        server.admission.limiters.clear()
+
+    summary = {}
+    for label, timings in (("background haiku", results[:len(background)]), ("interactive sonnet", results[len(background):])):
+        latencies = sorted(elapsed for _, elapsed in timings)
+        failures = sum(1 for status, _ in timings if status != 200)
+        summary[label] = latencies[len(latencies) // 2]
+        print(f"  {label:<20} {len(latencies)} requests, median {summary[label]:.2f}s, "
+              f"max {latencies[-1]:.2f}s" + (f", {failures} failed" if failures else ""))
+    return summary
+
+def make_session(turns, result_size=4000):
+    """A Claude Code style history: every turn reads a file and gets a large tool result back."""
+    messages = [{"role": "user", "content": "Please refactor the project."}]
+    for turn in range(turns):
+        tool_id = f"toolu_{turn:04d}"
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Step {turn}: reading the next file."},
+            {"type": "tool_use", "id": tool_id, "name": "Read", "input": {"file_path": f"/src/module_{turn}.py"}},
+        ]})
+        result = (f"line {turn}: def function_{turn}(): return {turn}\n" * (result_size // 40))[:result_size]
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": [{"type": "text", "text": result}]},
+        ]})
+    return messages
+
+def time_session_conversion(history, turns):
+    """Convert every turn of a session, each resending the whole history so far; returns total seconds."""
+    requests = [
+        server.MessagesRequest(**{**SIMPLE_REQUEST, "messages": history[:2 * turn + 1]})
+        for turn in range(turns + 1)
+    ]
+    # Don't charge the previous run's garbage to this one
+    gc.collect()
+    start_time = time.perf_counter()
+    for request in requests:
+        server.build_litellm_request(request)
+    return time.perf_counter() - start_time
+
+async def bench_conversion(args):
+    """Converting a growing session should only cost the new messages of each turn."""
+    history = make_session(args.turns)
+    cache = server.conversion_cache
+    original_max_bytes = cache.max_bytes
+    results = {}
+    try:
+        for label, max_bytes in (("without conversion cache", 0), ("with conversion cache", original_max_bytes)):
+            cache.clear()
+            cache.max_bytes = max_bytes
+            elapsed = time_session_conversion(history, args.turns)
+            results[label] = elapsed
+            print(f"  {label:<26} {args.turns} turns in {elapsed:.2f}s "
+                  f"({elapsed / (args.turns + 1) * 1000:.1f} ms per request)")
+    finally:
+        cache.max_bytes = original_max_bytes
+    print(f"  hit ratio: {cache.stats()['hit_ratio']:.1%}")
+    return results
+
+async def bench_converter(args):
+    """Converting one large history from scratch (conversion cache off): the previous converter vs. the current one.
+
+    Native tool calls are off, so every block goes through the converters being compared.
+    """
+    # About 4 KB per turn: a file read and its tool result
+    turns = max(1, int(args.history_mb * 1024 * 1024) // 4200)
+    history = make_session(turns)
+    iterations = 20
+    cache = server.conversion_cache
+    original_max_bytes = cache.max_bytes
+    original_native = server.NATIVE_TOOL_CALLS
+    current = (server.convert_message, server.convert_openai_message)
+    previous = (previous_convert_message, previous_convert_openai_message)
+    results = {}
+    try:
+        cache.max_bytes = 0
+        server.NATIVE_TOOL_CALLS = False
+        for model in ("openai/gpt-4.1", "gemini/gemini-2.5-pro"):
+            request = server.MessagesRequest(model=model, max_tokens=1024, messages=history)
+            size = len(request.model_dump_json())
+            row = {}
+            outputs = []
+            for label, (convert_message, convert_openai_message) in (("previous", previous), ("current", current)):
+                server.convert_message, server.convert_openai_message = convert_message, convert_openai_message
+                outputs.append(server.build_litellm_request(request)["messages"])
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    server.build_litellm_request(request)
+                elapsed = (time.perf_counter() - start) / iterations
+                tracemalloc.start()
+                server.build_litellm_request(request)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                row[label] = (elapsed, peak)
+            results[model] = row
+            (before, before_peak), (after, after_peak) = row["previous"], row["current"]
+            print(f"  {model:<22} {size / 1024 / 1024:.2f} MB history: {before * 1000:.1f} -> {after * 1000:.1f} ms per request "
+                  f"({before / after:.1f}x), peak allocations {before_peak / 1024 / 1024:.2f} -> {after_peak / 1024 / 1024:.2f} MB"
+                  + ("" if outputs[0] == outputs[1] else " (outputs differ!)"))
+    finally:
+        server.convert_message, server.convert_openai_message = current
+        server.NATIVE_TOOL_CALLS = original_native
+        cache.max_bytes = original_max_bytes
+    return results
+
+def time_call(function, min_seconds=0.2):
+    """Average seconds per call of function, repeated for at least min_seconds."""
+    gc.collect()
+    calls, start = 0, time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+async def bench_json(args):
+    """JSON work per request and per SSE chunk: the previous standard-library path vs. the configured backend."""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    large_turns = max(1, int(args.history_mb * 1024 * 1024) // 4200)
+    print(f"  backend: {server.JSON_ENGINE}\n")
+    for label, turns, text_size in (("typical", 10, 1000), (f"{args.history_mb:g} MB", large_turns, int(args.history_mb * 1024 * 1024))):
+        body = json.dumps({**SIMPLE_REQUEST, "messages": make_session(turns)}).encode("utf-8")
+        frame = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "x" * (text_size // 100 or 1)}}
+        response = server.MessagesResponse(
+            id="msg_bench", model="openai/gpt-4.1", role="assistant", stop_reason="end_turn",
+            content=[{"type": "text", "text": "x" * text_size}], usage=server.Usage(input_tokens=10, output_tokens=10),
+        )
+        rows = (
+            # The body used to be parsed by FastAPI (from bytes) and then again by create_message
+            (f"parse request ({len(body) / 1024:.0f} KB)",
+             lambda: (json.loads(body), json.loads(body.decode("utf-8"))), lambda: server.json_loads(body)),
+            (f"SSE frame ({len(frame['delta']['text'])} chars)",
+             lambda: json.dumps(frame), lambda: server.json_dumps(frame)),
+            (f"serialize response ({text_size / 1024:.0f} KB)",
+             lambda: JSONResponse(jsonable_encoder(response)).body, lambda: server.dump_model(response)),
+        )
+        print(f"  {label}")
+        for name, before, after in rows:
+            before_time, after_time = time_call(before), time_call(after)
+            print(f"    {name:<32} {before_time * 1e6:10.1f} us -> {after_time * 1e6:10.1f} us "
+                  f"({before_time / after_time:.1f}x)")
+
+# The tool definitions Claude Code sends with every request
+CLAUDE_CODE_TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "claude_code_tools.json")
+
+async def bench_tools(args):
+    """Translating the Claude Code tool set, with and without the tool definition cache."""
+    with open(CLAUDE_CODE_TOOLS) as f:
+        tools = json.load(f)
+    iterations = 1000
+    cache = server.tool_cache
+    original_max_entries = cache.max_entries
+    results = {}
+    try:
+        for model in ("openai/gpt-4.1", "gemini/gemini-2.5-pro"):
+            request = server.MessagesRequest(model=model, max_tokens=1024, tools=tools,
+                                             messages=[{"role": "user", "content": "hi"}])
+            for label, max_entries in (("without tool cache", 0), ("with tool cache", original_max_entries)):
+                cache.clear()
+                cache.max_entries = max_entries
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    server.convert_anthropic_to_litellm(request)
+                elapsed = time.perf_counter() - start
+                results[(model, label)] = elapsed
+                print(f"  {model:<22} {label:<19} {elapsed / iterations * 1000:.3f} ms per request "
+                      f"({len(tools)} tools)")
+    finally:
+        cache.max_entries = original_max_entries
+    return results
+
+BENCHMARKS = {
+    "concurrency": bench_concurrency,
+    "priority": bench_priority,
+    "conversion": bench_conversion,
+    "tools": bench_tools,
+    "converter": bench_converter,
+    "json": bench_json,
+}
+
+# ================= MAIN =================
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Claude Code Plus proxy")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="Number of concurrent requests")
+    parser.add_argument("--latency", type=float, default=1.0, help="Simulated upstream latency in seconds")
+    parser.add_argument("--turns", type=int, default=200, help="Conversation turns for the conversion benchmark")
+    parser.add_argument("--history-mb", type=float, default=1.0, help="History size for the converter and json benchmarks")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    for name in args.names or list(BENCHMARKS):
+        print(f"\n=========== {name.upper()} ===========\n")
+        await BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,11 +5,16 @@ import os
 import subprocess
 import sys
 from dotenv import set_key, get_key, find_dotenv
+from typing import Optional
 from typing_extensions import Annotated
 from pathlib import Path
 import signal
+import httpx
+from .disk_cache import DiskCache
 
 app = typer.Typer(add_completion=False, invoke_without_command=True)
+cache_app = typer.Typer(add_completion=False, help="Inspect or clear the persistent response cache.")
+app.add_typer(cache_app, name="cache")
 console = Console()
 error_console = Console(stderr=True)
 
@@ -17,6 +22,7 @@ error_console = Console(stderr=True)
 PID_FILE = Path(os.getcwd()) / ".ccp.pid"
 LOG_FILE = Path(os.getcwd()) / ".ccp.log"
 DEFAULT_PORT = "8082"
+DEFAULT_CACHE_MAX_BYTES = str(512 * 1024 * 1024)
 
 # --- Helper Functions ---
 def print_info(message):
@@ -42,6 +48,24 @@ def get_env_path():
         print_info(f"Created .env file at: {env_path}")
     return env_path
 
+def resolve_workers(workers):
+    """
+    Parses a --workers value ('auto' or a positive integer) into a worker count.
+    Returns None when no value was given.
+    """
+    if workers is None or workers == "":
+        return None
+    if workers.lower() == "auto":
+        return os.cpu_count() or 1
+    try:
+        count = int(workers)
+    except ValueError:
+        count = 0
+    if count < 1:
+        print_error(f"Invalid --workers value '{workers}'. Use a positive integer or 'auto'.")
+        sys.exit(1)
+    return count
+
 def is_server_really_running():
     """
     Checks if the server is actually running by verifying the PID.
@@ -166,6 +190,14 @@ def start(
             help="Automatically launch the Claude Code client after starting the server.",
         ),
     ] = False,
+    workers: Annotated[
+        Optional[str],
+        typer.Option(
+            "-w",
+            "--workers",
+            help="Production mode: run N worker processes (or 'auto' for one per CPU core) on the same port, without the reloader.",
+        ),
+    ] = None,
 ):
     """
     Starts the proxy server.
@@ -178,6 +210,7 @@ def start(
     
     env_path = find_dotenv()
     port = get_key(env_path, "PORT") or DEFAULT_PORT
+    num_workers = resolve_workers(workers or get_key(env_path, "WORKERS"))
 
     # Use the reliable check
     if is_server_really_running():
@@ -223,12 +256,20 @@ def start(
             port,
         ]
 
+        # The server splits its concurrency limits and rate-limit budgets between the workers
+        server_env = {**os.environ, "WORKERS": str(num_workers or 1)}
+        if num_workers:
+            # Uvicorn's supervisor pre-forks the workers onto one shared listening socket
+            command += ["--workers", str(num_workers)]
+            print_info(f"Production mode: {num_workers} worker processes.")
+
         if foreground:
             print_info("Starting server in foreground...")
             print_info("Run the following command in a new terminal to connect your client:")
             console.print(f"\n    [bold cyan]ANTHROPIC_BASE_URL=http://localhost:{port} claude[/bold cyan]\n")
             try:
-                subprocess.run(command + ["--reload", "--reload-dir", "src"])
+                # The auto-reloader is a development convenience; never run it with multiple workers
+                subprocess.run(command if num_workers else command + ["--reload", "--reload-dir", "src"], env=server_env)
             except KeyboardInterrupt:
                 print_info("\nServer stopped by user.")
             except Exception as e:
@@ -240,9 +281,10 @@ def start(
         print_info("Starting server in background...")
         try:
             # Redirect stdout/stderr to a log file
+            # Start a new session so the supervisor and its workers share a process group
             with open(LOG_FILE, "wb") as log_file:
                 process = subprocess.Popen(
-                    command, stdout=log_file, stderr=log_file
+                    command, stdout=log_file, stderr=log_file, start_new_session=True, env=server_env
                 )
             
             with open(PID_FILE, "w") as f:
@@ -307,7 +349,12 @@ def stop():
         sys.exit(1)
 
     try:
-        os.kill(pid, signal.SIGTERM)
+        try:
+            # Signal the whole process group so every worker goes down with the supervisor
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # Servers started without their own process group
+            os.kill(pid, signal.SIGTERM)
         print_info(f"Sent stop signal to process with PID: {pid}")
     except ProcessLookupError:
         print_warning(f"Process with PID {pid} not found. It may have already stopped.")
@@ -344,6 +391,52 @@ def logs():
         sys.exit(1)
 
 
+def open_disk_cache():
+    """Opens the server's on-disk response cache, as configured in the .env file."""
+    env_path = find_dotenv()
+    def setting(name, default):
+        return (env_path and get_key(env_path, name)) or os.environ.get(name) or default
+    path = setting("RESPONSE_CACHE_DISK_PATH", "")
+    max_bytes = int(setting("RESPONSE_CACHE_DISK_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES))
+    if not path:
+        print_warning("The persistent response cache is off. Set RESPONSE_CACHE_DISK_PATH to enable it.")
+        sys.exit(1)
+    if not os.path.exists(path):
+        print_warning(f"No response cache found at {os.path.abspath(path)}.")
+        sys.exit(1)
+    return DiskCache(path, max_bytes)
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+@cache_app.command("stats")
+def cache_stats():
+    """
+    Shows the size and contents of the on-disk response cache.
+    """
+    console.rule("[bold]Response Cache[/bold]")
+    stats = open_disk_cache().stats()
+    console.print(f"Path: {stats['path']}")
+    console.print(f"Entries: {stats['entries']} ({stats['expired_entries']} expired)")
+    ratio = stats["uncompressed_bytes"] / stats["bytes"] if stats["bytes"] else 0
+    console.print(f"Stored: {format_bytes(stats['bytes'])} of {format_bytes(stats['max_bytes'])} "
+                  f"({format_bytes(stats['uncompressed_bytes'])} uncompressed, {ratio:.1f}x)")
+    console.print(f"File size: {format_bytes(stats['file_bytes'])}")
+
+@cache_app.command("clear")
+def cache_clear():
+    """
+    Deletes every entry from the on-disk response cache.
+    """
+    console.rule("[bold]Response Cache[/bold]")
+    removed = open_disk_cache().clear()
+    print_success(f"Removed {removed} cached responses.")
+    if is_server_really_running():
+        print_info("Running workers keep their in-memory caches until they are restarted.")
+
 @app.command()
 def config():
     """
@@ -397,6 +490,32 @@ def check_anthropic_base_url_in_shell_config():
             f"Ensure 'export ANTHROPIC_BASE_URL=http://localhost:{port}' is set in your environment to use the proxy."
         )
 
+def print_circuit_breakers(port):
+    """Fetches upstream circuit breaker states from the running server and prints them."""
+    try:
+        response = httpx.get(f"http://localhost:{port}/v1/status", timeout=2)
+        runtime = response.json()
+        breakers = runtime.get("circuit_breakers", [])
+    except Exception as e:
+        print_warning(f"Could not fetch runtime status from the server: {e}")
+        return
+
+    console.print("\n[bold]Circuit Breakers[/bold]")
+    worker = runtime.get("worker") or {}
+    if worker.get("workers", 1) > 1:
+        # Each worker trips its own breakers; this is whichever one answered
+        console.print(f"[dim]As seen by worker PID {worker['pid']}, one of {worker['workers']}; each worker keeps its own breakers.[/dim]")
+    if not breakers:
+        console.print("No upstream calls yet.")
+        return
+    colors = {"closed": "green", "half_open": "yellow", "open": "red"}
+    for breaker in breakers:
+        color = colors.get(breaker["state"], "white")
+        line = f"{breaker['model']}: [{color}]{breaker['state']}[/{color}] (error rate {breaker['error_rate']:.0%})"
+        if "retry_in_seconds" in breaker:
+            line += f", probing again in {breaker['retry_in_seconds']}s"
+        console.print(line)
+
 def status():
     """
     Displays the server status and current configuration.
@@ -414,6 +533,7 @@ def status():
         console.print(f"Address: http://localhost:{port}")
         if LOG_FILE.exists():
             console.print(f"Log File: {LOG_FILE}")
+        print_circuit_breakers(port)
     else:
         print_info("Stopped")
 
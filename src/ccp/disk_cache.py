@@ -0,0 +1,144 @@
+import os
+import time
+import zlib
+import sqlite3
+from typing import Any, Dict, Optional, Tuple
+
+class DiskCache:
+    """A persistent response cache in SQLite, shared by every worker process.
+
+    Bodies are stored zlib-compressed. Entries expire at a wall-clock time, so they
+    survive restarts, and the least recently used ones are evicted to keep the
+    compressed total within max_bytes. WAL mode lets workers read while another writes.
+    The compressed total is kept in a meta row by triggers, so writes never sum the table,
+    and a hit only records its access time once every touch_interval seconds.
+    """
+
+    def __init__(self, path: str, max_bytes: int, touch_interval: float = 60.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        if not os.path.exists(path):
+            # Prompts and responses are stored in the clear; keep them private to the user.
+            # SQLite gives the -wal and -shm files the same permissions
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, model TEXT NOT NULL, body BLOB NOT NULL,"
+                " size INTEGER NOT NULL, raw_size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            # Running compressed total, updated in the same transaction as every insert and delete
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO meta SELECT 'size', COALESCE(SUM(size), 0) FROM entries")
+            db.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries"
+                " BEGIN UPDATE meta SET value = value + NEW.size WHERE name = 'size'; END"
+            )
+            db.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries"
+                " BEGIN UPDATE meta SET value = value - OLD.size WHERE name = 'size'; END"
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per operation keeps the cache safe to use from any thread
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes, float]]:
+        """Return (served model, body, expires_at) for a fresh entry, or None."""
+        now = time.time()
+        db = self._connect()
+        try:
+            row = db.execute(
+                "SELECT model, body, expires_at, accessed_at FROM entries WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            # Eviction only needs a rough recency order; touching every hit would queue reads behind writes
+            if now - row[3] >= self.touch_interval:
+                db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        finally:
+            db.close()
+        model, body, expires_at, _ = row
+        return model, zlib.decompress(body), expires_at
+
+    def put(self, key: str, model: str, body: bytes, expires_at: float) -> int:
+        """Store an entry, then evict expired and least recently used ones. Returns the number evicted."""
+        compressed = zlib.compress(body, 6)
+        if len(compressed) > self.max_bytes // 8:
+            return 0
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            # A plain DELETE then INSERT, since REPLACE's implicit delete does not fire the size trigger
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            db.execute(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, compressed, len(compressed), len(body), expires_at, now),
+            )
+            evicted = db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,)).rowcount
+            total = db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = db.execute("SELECT key, size FROM entries ORDER BY accessed_at LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for old_key, size in oldest:
+                    if total <= self.max_bytes:
+                        break
+                    db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    total -= size
+                    evicted += 1
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return evicted
+
+    def clear(self) -> int:
+        """Delete every entry and return how many there were."""
+        db = self._connect()
+        try:
+            removed = db.execute("DELETE FROM entries").rowcount
+            db.execute("VACUUM")
+        finally:
+            db.close()
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        db = self._connect()
+        try:
+            entries, size, raw_size, expired = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0),"
+                " COALESCE(SUM(expires_at <= ?), 0) FROM entries", (time.time(),)
+            ).fetchone()
+        finally:
+            db.close()
+        return {
+            "path": os.path.abspath(self.path),
+            "entries": entries,
+            "expired_entries": expired,
+            "bytes": size,
+            "uncompressed_bytes": raw_size,
+            "max_bytes": self.max_bytes,
+            "file_bytes": sum(os.path.getsize(self.path + suffix)
+                              for suffix in ("", "-wal") if os.path.exists(self.path + suffix)),
+        }
@@ -1,19 +1,31 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.routing import APIRoute
 import uvicorn
 import logging
 import json
-from pydantic import BaseModel, Field, field_validator
-from typing import List, Dict, Any, Optional, Union, Literal
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
+from typing import List, Dict, Any, Optional, Union, Literal, Callable, Tuple, Awaitable
 import httpx
 import os
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 import litellm
 import uuid
 import time
 from dotenv import load_dotenv
 import re
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
+import asyncio
+import contextvars
+import importlib.util
+import random
+import hashlib
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+from openai import AsyncOpenAI
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler
+from .disk_cache import DiskCache
 
 # Load environment variables from .env file
 load_dotenv()
@@ -76,13 +88,86 @@ for handler in logger.handlers:
     if isinstance(handler, logging.StreamHandler):
         handler.setFormatter(ColorizedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
 
-app = FastAPI()
+# --- JSON Backend ---
+# JSON library for request bodies, SSE frames and responses: "auto" uses orjson when it is installed, "stdlib" never does
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
 
-# Get API keys from environment
+if JSON_BACKEND != "stdlib" and importlib.util.find_spec("orjson") is not None:
+    import orjson
+    JSON_ENGINE = "orjson"
+
+    def json_loads(data: Union[bytes, str]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity are only accepted by the standard library
+            return json.loads(data)
+
+    def json_dumps(value: Any) -> str:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            # Integers beyond 64 bits and non-string keys
+            return json.dumps(value)
+
+    def dump_model(model: BaseModel) -> bytes:
+        try:
+            return orjson.dumps(model.model_dump())
+        except TypeError:
+            return model.__pydantic_serializer__.to_json(model)
+else:
+    if JSON_BACKEND == "orjson":
+        logger.warning("JSON_BACKEND=orjson, but orjson is not installed (pip install -e '.[fast]'); using the standard library")
+    JSON_ENGINE = "stdlib"
+    json_dumps = json.dumps
+
+    def json_loads(data: Union[bytes, str]) -> Any:
+        # json.loads decodes bytes with 'surrogatepass', which is much slower than plain UTF-8
+        return json.loads(data.decode("utf-8") if isinstance(data, bytes) else data)
+
+    def dump_model(model: BaseModel) -> bytes:
+        # pydantic's own serializer beats json.dumps(model.model_dump())
+        return model.__pydantic_serializer__.to_json(model)
+
+class JSONBackendRequest(Request):
+    """A request whose JSON body is parsed with the configured backend (once; FastAPI and handlers share it)."""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = json_loads(await self.body())
+        return self._json
+
+class JSONBackendRoute(APIRoute):
+    def get_route_handler(self) -> Callable[[Request], Awaitable[Response]]:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await handler(JSONBackendRequest(request.scope, request.receive))
+
+        return route_handler
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the long-lived upstream clients at startup and close them on shutdown."""
+    await upstream_pool.start()
+    try:
+        yield
+    finally:
+        await upstream_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = JSONBackendRoute
+
+# Get API keys from environment (each may be a comma-separated list to spread load across keys)
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+# Optional API base overrides (e.g. for Azure-style gateways or local mirrors); one per key, or one for all keys
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE")
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE")
+ANTHROPIC_API_BASE = os.environ.get("ANTHROPIC_API_BASE")
+
 # Validate that API keys are set
 if not OPENAI_API_KEY:
     logger.error("FATAL: OPENAI_API_KEY environment variable not set.")
@@ -96,9 +181,56 @@ PREFERRED_PROVIDER = os.environ.get("PREFERRED_PROVIDER", "openai").lower()
 
 # Get model mapping configuration from environment
 # Default to latest OpenAI models if not set
+# Either may be a comma-separated fallback chain, e.g. "openai/gpt-4.1,gemini/gemini-2.5-pro"
 BIG_MODEL = os.environ.get("BIG_MODEL", "gpt-4.1")
 SMALL_MODEL = os.environ.get("SMALL_MODEL", "gpt-4.1-mini")
 
+def resolve_model_chain(value: str) -> List[str]:
+    """Split a comma-separated model list into provider-prefixed model names."""
+    default_prefix = "gemini/" if PREFERRED_PROVIDER == "google" else "openai/"
+    chain = []
+    for name in value.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if not name.startswith(("openai/", "gemini/", "anthropic/")):
+            name = default_prefix + name
+        chain.append(name)
+    return chain
+
+BIG_MODEL_CHAIN = resolve_model_chain(BIG_MODEL)
+SMALL_MODEL_CHAIN = resolve_model_chain(SMALL_MODEL)
+
+# Fall back to the next model in the chain if no first token arrives within this many seconds (0 disables)
+FALLBACK_TTFT_SECONDS = float(os.environ.get("FALLBACK_TTFT_SECONDS", "0"))
+
+# Providers that receive Anthropic cache_control breakpoints for prompt caching (OpenAI caches prefixes automatically)
+PROMPT_CACHE_PROVIDERS = {p.strip() for p in os.environ.get("PROMPT_CACHE_PROVIDERS", "anthropic,gemini").lower().split(",") if p.strip()}
+
+# Send tool calls and results as OpenAI tool_calls / "tool" messages instead of flattening them into text
+NATIVE_TOOL_CALLS = os.environ.get("NATIVE_TOOL_CALLS", "true").lower() == "true"
+
+# Worker processes serving this port ('auto' or a number; 'ccp start --workers' passes its value on).
+# Each worker keeps its own limiters, breakers, key pools and caches, so server-wide limits are split between them
+def resolve_worker_count(value: Optional[str]) -> int:
+    """Parse a WORKERS value the way 'ccp start' does; anything unset or invalid means a single process."""
+    if value and value.strip().lower() == "auto":
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value or 1))
+    except ValueError:
+        return 1
+
+WORKER_COUNT = resolve_worker_count(os.environ.get("WORKERS"))
+
+def per_worker(limit: int) -> int:
+    """This worker's share of a server-wide limit (at least 1; 0 and below keep their meaning)."""
+    return max(1, limit // WORKER_COUNT) if limit > 0 else limit
+
+# Maximum number of non-streaming upstream calls in flight at once across all workers (0 = unlimited)
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "64"))
+upstream_semaphore = asyncio.Semaphore(per_worker(MAX_CONCURRENT_REQUESTS)) if MAX_CONCURRENT_REQUESTS > 0 else None
+
 # List of OpenAI models
 OPENAI_MODELS = [
     "o3-mini",
@@ -121,52 +253,1199 @@ GEMINI_MODELS = [
     "gemini-2.0-flash"
 ]
 
+def get_provider(model: str) -> str:
+    """Return the provider prefix ('openai', 'gemini' or 'anthropic') of a routed model name."""
+    if model.startswith("openai/"):
+        return "openai"
+    if model.startswith("gemini/"):
+        return "gemini"
+    return "anthropic"
+
+# --- Upstream HTTP Connection Pool ---
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "true").lower() == "true"
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+
+DEFAULT_API_BASES = {
+    "openai": "https://api.openai.com/v1",
+    "gemini": "https://generativelanguage.googleapis.com",
+    "anthropic": "https://api.anthropic.com",
+}
+
+class UpstreamClientPool:
+    """Long-lived httpx clients, one per (provider, API base), shared by all requests."""
+
+    def __init__(self):
+        # HTTP/2 needs the optional 'h2' package; fall back to HTTP/1.1 keep-alive without it
+        self.http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+        self.limits = httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        )
+        self._clients: Dict[tuple, httpx.AsyncClient] = {}
+        self._litellm_clients: Dict[tuple, Any] = {}
+
+    async def start(self):
+        """Create the clients for every provider up front."""
+        if UPSTREAM_HTTP2 and not self.http2:
+            logger.warning("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+        for pool in key_pools.values():
+            for key in pool.keys:
+                self.get(pool.provider, key.api_base)
+
+    def get(self, provider: str, api_base: Optional[str] = None) -> httpx.AsyncClient:
+        """Return the shared httpx client for a provider and API base, creating it on first use."""
+        key = (provider, api_base or DEFAULT_API_BASES.get(provider, ""))
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+            self._clients[key] = client
+            logger.debug(f"Opened upstream client pool for {key[0]} at {key[1]} (http2={self.http2})")
+        return client
+
+    async def litellm_client(self, provider: str, api_key: Optional[str], api_base: Optional[str] = None):
+        """Return a LiteLLM-compatible client that sends its traffic through the shared pool."""
+        http_client = self.get(provider, api_base)
+        # OpenAI SDK clients carry the API key, other providers only need the transport
+        key = (provider, api_base, api_key if provider == "openai" else None)
+        cached = self._litellm_clients.get(key)
+        if cached is not None and cached[0] is http_client:
+            return cached[1]
+
+        own_client = None
+        if provider == "openai":
+            client = AsyncOpenAI(api_key=api_key, base_url=api_base or DEFAULT_API_BASES["openai"], http_client=http_client, max_retries=0)
+        else:
+            # The handler always opens an httpx client of its own; swap in the pooled one and close it
+            client = AsyncHTTPHandler()
+            own_client = client.client
+            client.client = http_client
+        self._litellm_clients[key] = (http_client, client)
+        if own_client is not None:
+            await own_client.aclose()
+        return client
+
+    async def close(self):
+        """Close every pooled client."""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._litellm_clients.clear()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Report open, idle, active and waiting connections for every pool."""
+        stats = []
+        for (provider, api_base), client in self._clients.items():
+            # httpx does not expose pool state publicly, so read it from the httpcore pool
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            pending = list(getattr(pool, "_requests", []))
+            idle = sum(1 for connection in connections if connection.is_idle())
+            stats.append({
+                "provider": provider,
+                "api_base": api_base,
+                "http2": self.http2,
+                "closed": client.is_closed,
+                "open": len(connections),
+                "idle": idle,
+                "active": len(connections) - idle,
+                "waiting": sum(1 for request in pending if request.is_queued()),
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+            })
+        return stats
+
+upstream_pool = UpstreamClientPool()
+
+# --- Metrics ---
+class Metrics:
+    """Minimal in-process counters, timing summaries and gauges in Prometheus text format."""
+
+    def __init__(self):
+        self.counters: Dict[str, Dict[Tuple, float]] = {}
+        self.summaries: Dict[str, Dict[Tuple, List[float]]] = {}
+        self.gauges: Dict[str, Callable[[], List[Tuple[Dict[str, Any], float]]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter."""
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a sample (e.g. a duration in seconds) in a count/sum summary."""
+        series = self.summaries.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        summary = series.setdefault(key, [0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+
+    def gauge(self, name: str, callback: Callable[[], List[Tuple[Dict[str, Any], float]]]):
+        """Register a gauge whose (labels, value) samples are read at scrape time."""
+        self.gauges[name] = callback
+
+    def get(self, name: str, **labels) -> float:
+        """Return the current value of a counter."""
+        return self.counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        items = labels.items() if isinstance(labels, dict) else labels
+        return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name, series in self.summaries.items():
+            lines.append(f"# TYPE {name} summary")
+            for labels, (count, total) in series.items():
+                lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+        for name, callback in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in callback():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+# Each worker serves its own metrics; the pid label tells which worker a scrape reached
+metrics.gauge("ccp_workers", lambda: [({"pid": os.getpid()}, WORKER_COUNT)])
+
+# --- Errors ---
+class ProxyError(Exception):
+    """An error raised by the proxy itself and returned in Anthropic's error format."""
+    status_code = 500
+    error_type = "api_error"
+
+    def __init__(self, message: str, status_code: Optional[int] = None, error_type: Optional[str] = None):
+        super().__init__(message)
+        if status_code is not None:
+            self.status_code = status_code
+        if error_type is not None:
+            self.error_type = error_type
+
+class OverloadedError(ProxyError):
+    """Raised when a request cannot be admitted because its upstream is saturated."""
+    status_code = 529
+    error_type = "overloaded_error"
+
+def anthropic_error_body(error_type: str, message: str) -> Dict[str, Any]:
+    """Build an error payload in Anthropic's format."""
+    return {"type": "error", "error": {"type": error_type, "message": message}}
+
+# Anthropic error types by upstream HTTP status
+ANTHROPIC_ERROR_TYPES = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    403: "permission_error",
+    404: "not_found_error",
+    413: "request_too_large",
+    429: "rate_limit_error",
+    503: "overloaded_error",
+    504: "timeout_error",
+    529: "overloaded_error",
+}
+
+def anthropic_error_type(exc: BaseException) -> str:
+    """Map a proxy or upstream exception to the closest Anthropic error type."""
+    if isinstance(exc, ProxyError):
+        return exc.error_type
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, "response", None), "status_code", None)
+    if status_code in ANTHROPIC_ERROR_TYPES:
+        return ANTHROPIC_ERROR_TYPES[status_code]
+    if isinstance(exc, (litellm.Timeout, asyncio.TimeoutError)):
+        return "timeout_error"
+    return "api_error"
+
+@app.exception_handler(ProxyError)
+async def proxy_error_handler(request: Request, exc: ProxyError):
+    return JSONResponse(status_code=exc.status_code, content=anthropic_error_body(exc.error_type, str(exc)))
+
+# --- Admission Control ---
+def parse_limit_map(value: Optional[str], cast: Callable[[str], Any] = int) -> Dict[str, Any]:
+    """Parse 'key=limit,key=limit' settings such as 'openai=32,gemini=16'."""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        key, limit = item.rsplit("=", 1)
+        try:
+            limits[key.strip()] = cast(limit)
+        except ValueError:
+            logger.warning(f"Ignoring invalid limit '{item.strip()}'")
+    return limits
+
+# Concurrent upstream requests per provider ('openai=32,gemini=16') and per routed model
+# ('openai/gpt-4.1=16'); providers and models without an entry are not limited
+PROVIDER_CONCURRENCY = parse_limit_map(os.environ.get("PROVIDER_CONCURRENCY"))
+MODEL_CONCURRENCY = parse_limit_map(os.environ.get("MODEL_CONCURRENCY"))
+# Requests allowed to wait for a slot per limit, and how long they may wait
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Queued requests are served by weighted fair queuing across priority classes, highest first on ties
+PRIORITY_CLASSES = ("interactive", "normal", "background")
+PRIORITY_WEIGHTS = {"interactive": 8, "normal": 4, "background": 1}
+PRIORITY_WEIGHTS.update({
+    name: weight for name, weight in parse_limit_map(os.environ.get("PRIORITY_WEIGHTS")).items()
+    if name in PRIORITY_CLASSES and weight > 0
+})
+
+class AdmissionLimiter:
+    """A concurrency limit with a bounded wait queue, shared fairly between priority classes.
+
+    Waiting requests are dispatched by stride scheduling: each class advances by 1/weight
+    per request served, and the class that is furthest behind goes next, so under
+    saturation an interactive:background weight of 8:1 serves eight interactive requests
+    for every background one without starving either.
+    """
+
+    def __init__(self, scope: str, key: str, limit: int, max_queue: int):
+        self.scope = scope
+        self.key = key
+        self.limit = limit
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queues: Dict[str, deque] = {name: deque() for name in PRIORITY_CLASSES}
+        self.passes: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        self.virtual_time = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def acquire(self, timeout: float, priority: str = "normal"):
+        """Wait for a slot, failing fast with OverloadedError when the queue is full or the wait times out."""
+        start_time = time.monotonic()
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            metrics.observe("ccp_admission_wait_seconds", 0.0, scope=self.scope, key=self.key, priority=priority)
+            return
+        if self.waiting >= self.max_queue:
+            metrics.inc("ccp_admission_rejected_total", scope=self.scope, key=self.key, reason="queue_full")
+            raise OverloadedError(f"Too many queued requests for {self.scope} '{self.key}'")
+
+        queue = self.queues[priority]
+        if not queue:
+            # A class that was idle resumes at the current virtual time rather than with banked credit
+            self.passes[priority] = max(self.passes[priority], self.virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just as the wait ended; hand it to the next request
+                self.release()
+            elif waiter in queue:
+                queue.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc("ccp_admission_rejected_total", scope=self.scope, key=self.key, reason="timeout")
+                raise OverloadedError(f"Timed out after {timeout:.0f}s waiting for {self.scope} '{self.key}'")
+            raise
+        finally:
+            metrics.observe("ccp_admission_wait_seconds", time.monotonic() - start_time, scope=self.scope, key=self.key, priority=priority)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_flight < self.limit:
+            ready = [name for name in PRIORITY_CLASSES if self.queues[name]]
+            if not ready:
+                return
+            name = min(ready, key=lambda name: self.passes[name])
+            waiter = self.queues[name].popleft()
+            if waiter.done():
+                continue
+            self.virtual_time = self.passes[name]
+            self.passes[name] += 1 / PRIORITY_WEIGHTS[name]
+            self.in_flight += 1
+            waiter.set_result(None)
+
+class AdmissionTicket:
+    """The slots held by one admitted request; release() is safe to call more than once."""
+
+    def __init__(self, limiters: List[AdmissionLimiter]):
+        self.limiters = limiters
+        self.callbacks: List[Callable[[], None]] = []
+
+    def on_release(self, callback: Callable[[], None]):
+        """Run callback when the ticket is released, e.g. to free the API key a stream is using."""
+        self.callbacks.append(callback)
+
+    def release(self):
+        limiters, self.limiters = self.limiters, []
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        for limiter in reversed(limiters):
+            limiter.release()
+
+class AdmissionController:
+    """Per-provider and per-model limiters, so traffic to different backends is isolated."""
+
+    def __init__(self, provider_limits: Dict[str, int], model_limits: Dict[str, int], max_queue: int, timeout: float):
+        self.provider_limits = provider_limits
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.limiters: Dict[Tuple[str, str], AdmissionLimiter] = {}
+
+    def _limiter(self, scope: str, key: str, limit: Optional[int]) -> Optional[AdmissionLimiter]:
+        if not limit or limit <= 0:
+            return None
+        limiter = self.limiters.get((scope, key))
+        if limiter is None:
+            limiter = AdmissionLimiter(scope, key, limit, self.max_queue)
+            self.limiters[(scope, key)] = limiter
+        return limiter
+
+    async def admit(self, model: str, priority: str = "normal") -> AdmissionTicket:
+        """Acquire the model slot, then the provider slot, for a routed model name."""
+        provider = get_provider(model)
+        candidates = [
+            self._limiter("model", model, self.model_limits.get(model)),
+            self._limiter("provider", provider, self.provider_limits.get(provider)),
+        ]
+        ticket = AdmissionTicket([])
+        try:
+            for limiter in candidates:
+                if limiter is None:
+                    continue
+                await limiter.acquire(self.timeout, priority)
+                ticket.limiters.append(limiter)
+        except BaseException:
+            ticket.release()
+            raise
+        return ticket
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "scope": limiter.scope,
+                "key": limiter.key,
+                "limit": limiter.limit,
+                "in_flight": limiter.in_flight,
+                "queued": limiter.waiting,
+                "queued_by_priority": {name: len(queue) for name, queue in limiter.queues.items()},
+                "max_queue": limiter.max_queue,
+            }
+            for limiter in self.limiters.values()
+        ]
+
+admission = AdmissionController(
+    {provider: per_worker(limit) for provider, limit in PROVIDER_CONCURRENCY.items()},
+    {model: per_worker(limit) for model, limit in MODEL_CONCURRENCY.items()},
+    per_worker(ADMISSION_QUEUE_SIZE),
+    ADMISSION_QUEUE_TIMEOUT,
+)
+
+metrics.gauge("ccp_admission_queue_depth", lambda: [
+    ({"scope": limiter.scope, "key": limiter.key}, limiter.waiting) for limiter in admission.limiters.values()
+])
+metrics.gauge("ccp_admission_in_flight", lambda: [
+    ({"scope": limiter.scope, "key": limiter.key}, limiter.in_flight) for limiter in admission.limiters.values()
+])
+
+# --- Upstream Retries ---
+# Retries per request for 429/5xx and connection errors (0 disables retries)
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "20"))
+# Maximum extra time a single request may spend on retries
+RETRY_BUDGET_SECONDS = float(os.environ.get("RETRY_BUDGET_SECONDS", "60"))
+# Maximum retries per second across all requests, so retries cannot amplify an outage
+RETRY_RATE_LIMIT = float(os.environ.get("RETRY_RATE_LIMIT", "10"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 529}
+
+def get_status_code(exc: BaseException) -> Optional[int]:
+    """Return the HTTP status code carried by an upstream exception, if any."""
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+def is_transport_error(exc: BaseException) -> bool:
+    """Whether exc is, or was raised from, a network failure or timeout talking to the upstream."""
+    if isinstance(exc, litellm.Timeout):
+        return True
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, (httpx.TransportError, ConnectionError, asyncio.TimeoutError)):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+def is_retryable(exc: BaseException) -> bool:
+    """Rate limits, server errors and dropped connections are worth retrying."""
+    if isinstance(exc, ProxyError):
+        # Raised by the proxy itself (e.g. an open circuit breaker), not by the upstream
+        return False
+    if is_transport_error(exc):
+        return True
+    if isinstance(exc, litellm.APIConnectionError):
+        # LiteLLM also raises this, with a made-up 500, for requests it failed to build or
+        # validate; those fail the same way every time
+        return False
+    return get_status_code(exc) in RETRYABLE_STATUS_CODES
+
+def get_error_headers(exc: BaseException):
+    """Return the HTTP headers of an upstream error response, if LiteLLM kept them."""
+    return getattr(exc, "litellm_response_headers", None) or getattr(getattr(exc, "response", None), "headers", None)
+
+def get_retry_after(exc: BaseException) -> Optional[float]:
+    """Read the retry-after(-ms) header of an upstream error response, in seconds."""
+    headers = get_error_headers(exc)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP-date form
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RetryRateLimiter:
+    """Token bucket capping the global rate of retries."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+retry_limiter = RetryRateLimiter(RETRY_RATE_LIMIT)
+
+async def with_retries(call: Callable[[], Any], model: str):
+    """Await call(), retrying retryable upstream errors with exponential backoff and full jitter."""
+    provider = get_provider(model)
+    start_time = time.monotonic()
+    attempt = 0
+    while True:
+        attempt_start = time.monotonic()
+        try:
+            result = await call()
+            if attempt:
+                metrics.observe("ccp_upstream_retry_added_seconds", attempt_start - start_time, provider=provider)
+            return result
+        except Exception as e:
+            status_code = get_status_code(e)
+            # A rate-limited or rejected key is rested by its pool, so another key can be tried at once
+            key_failover = status_code in (401, 403, 429) and has_spare_key(provider)
+            if not is_retryable(e) and not key_failover:
+                raise
+            reason = str(status_code or type(e).__name__)
+            elapsed = time.monotonic() - start_time
+
+            if key_failover:
+                delay = 0.0
+            else:
+                # Honor retry-after when the provider sends it, otherwise back off exponentially
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+            give_up = None
+            if attempt >= RETRY_MAX_ATTEMPTS:
+                give_up = "attempts"
+            elif elapsed + delay > RETRY_BUDGET_SECONDS:
+                give_up = "budget"
+            elif not retry_limiter.try_acquire():
+                give_up = "rate_cap"
+            if give_up:
+                if attempt:
+                    metrics.observe("ccp_upstream_retry_added_seconds", time.monotonic() - start_time, provider=provider)
+                if RETRY_MAX_ATTEMPTS > 0:
+                    metrics.inc("ccp_upstream_retries_exhausted_total", provider=provider, reason=give_up)
+                raise
+
+            attempt += 1
+            metrics.inc("ccp_upstream_retries_total", provider=provider, reason=reason)
+            logger.warning(f"Upstream error ({reason}) for {model}; retry {attempt}/{RETRY_MAX_ATTEMPTS} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+# --- Circuit Breakers ---
+# Sliding window over which upstream error rates are measured
+BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", "60"))
+# Minimum calls in the window before the breaker may open
+BREAKER_MIN_REQUESTS = int(os.environ.get("BREAKER_MIN_REQUESTS", "10"))
+# Fraction of failed (or slow) calls in the window that opens the breaker
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+# Calls slower than this many seconds count as failures (0 disables the latency check)
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("BREAKER_SLOW_CALL_SECONDS", "60"))
+# How long the breaker stays open before letting probe traffic through
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+# Concurrent probe calls allowed while half-open; this many successes close the breaker
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get("BREAKER_HALF_OPEN_PROBES", "1"))
+
+class FirstTokenTimeoutError(ProxyError):
+    """Raised when an upstream misses the time-to-first-token deadline used for fallbacks."""
+    status_code = 504
+    error_type = "api_error"
+
+class CircuitOpenError(OverloadedError):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+# Seconds the current logical request has spent in upstream calls, excluding local queueing, rate-limit
+# pacing and retry backoff; set by with_circuit_breaker and added to by with_api_key
+upstream_elapsed: contextvars.ContextVar[List[float]] = contextvars.ContextVar("upstream_elapsed")
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker driven by the error rate and latency of recent calls."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, model: str):
+        self.model = model
+        self.state = self.CLOSED
+        self.calls = deque()  # (timestamp, failed) pairs inside the window
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+    def _trim(self, now: float):
+        while self.calls and now - self.calls[0][0] > BREAKER_WINDOW_SECONDS:
+            self.calls.popleft()
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker for {self.model}: {self.state} -> {state}")
+            metrics.inc("ccp_circuit_transitions_total", model=self.model, state=state)
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        elif state == self.HALF_OPEN:
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        elif state == self.CLOSED:
+            self.calls.clear()
+
+    def allow(self) -> bool:
+        """Return True if a call may go upstream now (reserving a probe slot when half-open)."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= BREAKER_OPEN_SECONDS:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and self.probes_in_flight < BREAKER_HALF_OPEN_PROBES:
+            self.probes_in_flight += 1
+            return True
+        return False
+
+    def record(self, failed: Optional[bool], latency: float, probe: bool):
+        """Record a call outcome; failed=None means the call was abandoned without a result."""
+        if failed is not None and BREAKER_SLOW_CALL_SECONDS > 0 and latency > BREAKER_SLOW_CALL_SECONDS:
+            failed = True
+
+        if probe:
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+            if self.state != self.HALF_OPEN or failed is None:
+                return
+            if failed:
+                self._transition(self.OPEN)
+            else:
+                self.probe_successes += 1
+                if self.probe_successes >= BREAKER_HALF_OPEN_PROBES:
+                    self._transition(self.CLOSED)
+            return
+
+        if failed is None or self.state != self.CLOSED:
+            return
+        now = time.monotonic()
+        self.calls.append((now, failed))
+        self._trim(now)
+        if len(self.calls) >= BREAKER_MIN_REQUESTS and self.error_rate() >= BREAKER_ERROR_RATE:
+            self._transition(self.OPEN)
+
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, failed in self.calls if failed) / len(self.calls)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "model": self.model,
+            "provider": get_provider(self.model),
+            "state": self.state,
+            "calls_in_window": len(self.calls),
+            "error_rate": round(self.error_rate(), 3),
+        }
+        if self.state == self.OPEN:
+            stats["retry_in_seconds"] = round(max(0.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)), 1)
+        return stats
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(model: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(model)
+    if breaker is None:
+        breaker = circuit_breakers[model] = CircuitBreaker(model)
+    return breaker
+
+BREAKER_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+metrics.gauge("ccp_circuit_state", lambda: [
+    ({"model": breaker.model}, BREAKER_STATE_VALUES[breaker.state]) for breaker in circuit_breakers.values()
+])
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """Network failures, stalls and 429/5xx responses; errors that say something about the upstream's health."""
+    if isinstance(exc, FirstTokenTimeoutError):
+        return True
+    if isinstance(exc, ProxyError):
+        return False
+    if is_transport_error(exc):
+        return True
+    if isinstance(exc, litellm.APIConnectionError):
+        # Raised (with a made-up 500) for requests LiteLLM failed to build, i.e. bad client input
+        return False
+    status_code = get_status_code(exc)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+async def with_circuit_breaker(call: Callable[[], Any], model: str):
+    """Await call() unless the model's breaker is open, and feed the outcome back to the breaker.
+
+    call is one logical request including its retries, so a request counts once however
+    many attempts it took. Its latency is the time spent upstream (see upstream_elapsed), so
+    waiting for a local slot never makes a healthy model look slow.
+    """
+    breaker = get_circuit_breaker(model)
+    if not breaker.allow():
+        metrics.inc("ccp_circuit_rejected_total", model=model)
+        raise CircuitOpenError(f"Upstream for '{model}' is failing; circuit breaker is open")
+    probe = breaker.state == CircuitBreaker.HALF_OPEN
+
+    elapsed = [0.0]
+    token = upstream_elapsed.set(elapsed)
+    try:
+        result = await call()
+    except Exception as e:
+        # Client errors (bad request, auth) say nothing about the upstream's health
+        breaker.record(is_upstream_failure(e), elapsed[0], probe)
+        raise
+    except BaseException:
+        breaker.record(None, elapsed[0], probe)
+        raise
+    finally:
+        upstream_elapsed.reset(token)
+    breaker.record(False, elapsed[0], probe)
+    return result
+
+# --- Rate Limit Budgets ---
+# Pace requests to each key using the provider's x-ratelimit-* response headers instead of waiting for 429s
+RATE_LIMIT_SCHEDULING = os.environ.get("RATE_LIMIT_SCHEDULING", "true").lower() == "true"
+# Longest a request may be held back for budget; beyond this it moves to the next model or gets a 529
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "10"))
+# Characters per token when estimating a request's token cost
+RATE_LIMIT_CHARS_PER_TOKEN = float(os.environ.get("RATE_LIMIT_CHARS_PER_TOKEN", "4"))
+
+class RateLimitBudgetError(OverloadedError):
+    """Raised when every key would have to wait too long for rate-limit budget."""
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse a rate limit reset header: OpenAI durations ("1m30s", "250ms"), seconds, or an RFC 3339 time."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+    except ValueError:
+        return None
+
+def read_rate_limit(headers, kind: str) -> Optional[Tuple[Optional[float], float, Optional[float]]]:
+    """Return (limit, remaining, reset seconds) for "requests" or "tokens" from OpenAI- or Anthropic-style headers."""
+    if not headers:
+        return None
+    def header(*names):
+        for name in names:
+            # LiteLLM keeps the raw provider headers under an llm_provider- prefix
+            for key in (f"llm_provider-{name}", name):
+                value = headers.get(key)
+                if value is not None:
+                    return value
+        return None
+    remaining = header(f"x-ratelimit-remaining-{kind}", f"anthropic-ratelimit-{kind}-remaining")
+    if remaining is None:
+        return None
+    try:
+        limit = header(f"x-ratelimit-limit-{kind}", f"anthropic-ratelimit-{kind}-limit")
+        return (
+            float(limit) if limit is not None else None,
+            float(remaining),
+            parse_reset_duration(header(f"x-ratelimit-reset-{kind}", f"anthropic-ratelimit-{kind}-reset")),
+        )
+    except ValueError:
+        return None
+
+def get_response_headers(response) -> Dict[str, str]:
+    """Return the upstream HTTP headers LiteLLM attached to a response or stream."""
+    hidden_params = getattr(response, "_hidden_params", None) or {}
+    return hidden_params.get("additional_headers") or {}
+
+def estimate_token_cost(request: "MessagesRequest", litellm_request: Dict[str, Any]) -> int:
+    """Estimate a request's cost the way provider token limits count it: prompt tokens plus max_tokens.
+
+    The size of the converted messages comes from the conversion cache, which measured them when
+    they were converted; only conversions it does not hold are measured again.
+    """
+    model = litellm_request["model"]
+    chars = conversion_cache.converted_chars(request, message_dialect("openai" in model, supports_cache_control(model)))
+    if chars is None:
+        chars = ConversionCache.estimate_size(litellm_request.get("messages", [])) // 2
+    if isinstance(request.system, str):
+        chars += len(request.system)
+    elif request.system:
+        chars += sum(len(block.text) for block in request.system)
+    for tool in request.tools or ():
+        chars += len(tool.__pydantic_serializer__.to_json(tool))
+    return int(chars / RATE_LIMIT_CHARS_PER_TOKEN) + int(litellm_request.get("max_tokens") or 0)
+
+class RateLimitBucket:
+    """A local token bucket mirroring one provider-side limit, corrected by every response's headers.
+
+    Requests reserve their cost up front, so the level may go negative; that debt is the
+    time later requests have to wait.
+    """
+
+    def __init__(self):
+        self.limit: Optional[float] = None
+        self.level = 0.0
+        self.refill_rate = 0.0  # units per second
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.limit is not None and self.refill_rate > 0:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def sync(self, limit: Optional[float], remaining: float, reset_seconds: Optional[float]):
+        """Adopt the provider's view of the limit, or this worker's share of it."""
+        # Every worker sees the key's whole budget in the headers, so each paces itself to its share
+        if limit:
+            limit /= WORKER_COUNT
+        remaining /= WORKER_COUNT
+        if limit:
+            self.limit = limit
+        elif self.limit is None or remaining > self.limit:
+            self.limit = remaining
+        if reset_seconds and remaining < self.limit:
+            # The reset header is the time until the bucket is full again
+            self.refill_rate = (self.limit - remaining) / reset_seconds
+        elif not self.refill_rate:
+            # Provider limits are usually per minute
+            self.refill_rate = self.limit / 60
+        self.level = remaining
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost: float) -> float:
+        """Seconds until cost would fit in the bucket (0 while the limit is unknown)."""
+        if self.limit is None:
+            return 0.0
+        self._refill(time.monotonic())
+        cost = min(cost, self.limit)
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.refill_rate if self.refill_rate > 0 else RATE_LIMIT_MAX_WAIT
+
+    def reserve(self, cost: float) -> float:
+        """Take cost from the bucket and return how long to wait before sending."""
+        wait = self.wait_time(cost)
+        if self.limit is not None:
+            self.level -= min(cost, self.limit)
+        return wait
+
+    def refund(self, cost: float):
+        if self.limit is not None:
+            self.level = min(self.limit, self.level + min(cost, self.limit))
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        if self.limit is None:
+            return None
+        self._refill(time.monotonic())
+        return {"limit": self.limit, "remaining": round(self.level, 1), "refill_per_second": round(self.refill_rate, 3)}
+
+# --- API Key Pools ---
+# How to choose among a provider's keys: "least_outstanding" or "ewma" (lowest recent latency)
+KEY_SELECTION = os.environ.get("KEY_SELECTION", "least_outstanding").lower()
+# Seconds a key is taken out of rotation after a 429 without retry-after, or after an auth error
+KEY_RATE_LIMIT_COOLDOWN = float(os.environ.get("KEY_RATE_LIMIT_COOLDOWN", "30"))
+KEY_AUTH_COOLDOWN = float(os.environ.get("KEY_AUTH_COOLDOWN", "300"))
+# Weight of the newest sample in each key's latency moving average
+KEY_EWMA_ALPHA = float(os.environ.get("KEY_EWMA_ALPHA", "0.3"))
+
+def mask_key(api_key: Optional[str]) -> str:
+    """Identify a key in logs and metrics without revealing it."""
+    if not api_key:
+        return "none"
+    return f"...{api_key[-4:]}" if len(api_key) > 8 else "***"
+
+class UpstreamKey:
+    """One API key, and the API base it is used with, for a provider."""
+
+    def __init__(self, provider: str, api_key: Optional[str], api_base: Optional[str]):
+        self.provider = provider
+        self.api_key = api_key
+        self.api_base = api_base
+        self.label = mask_key(api_key)
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.request_budget = RateLimitBucket()
+        self.token_budget = RateLimitBucket()
+
+    def is_available(self, now: float) -> bool:
+        return self.cooldown_until <= now
+
+    def budget_wait(self, token_cost: int) -> float:
+        """Seconds until this key has rate-limit budget for one more request of token_cost."""
+        if not RATE_LIMIT_SCHEDULING:
+            return 0.0
+        return max(self.request_budget.wait_time(1), self.token_budget.wait_time(token_cost))
+
+    def reserve_budget(self, token_cost: int) -> float:
+        if not RATE_LIMIT_SCHEDULING:
+            return 0.0
+        return max(self.request_budget.reserve(1), self.token_budget.reserve(token_cost))
+
+    def refund_budget(self, token_cost: int):
+        if RATE_LIMIT_SCHEDULING:
+            self.request_budget.refund(1)
+            self.token_budget.refund(token_cost)
+
+    def sync_rate_limits(self, headers):
+        """Resynchronize the key's budgets from an upstream response's rate limit headers."""
+        for kind, bucket in (("requests", self.request_budget), ("tokens", self.token_budget)):
+            rate_limit = read_rate_limit(headers, kind)
+            if rate_limit is not None:
+                bucket.sync(*rate_limit)
+
+    def stats(self) -> Dict[str, Any]:
+        cooldown = max(0.0, self.cooldown_until - time.monotonic())
+        return {
+            "provider": self.provider,
+            "key": self.label,
+            "api_base": self.api_base or DEFAULT_API_BASES.get(self.provider),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ewma": round(self.latency, 3) if self.latency is not None else None,
+            "cooldown_seconds": round(cooldown, 1),
+            "request_budget": self.request_budget.stats(),
+            "token_budget": self.token_budget.stats(),
+        }
+
+class KeyPool:
+    """Balances a provider's requests across its keys, resting keys that are rate-limited or rejected."""
+
+    def __init__(self, provider: str, keys: List[UpstreamKey]):
+        self.provider = provider
+        self.keys = keys
+
+    def available(self) -> List[UpstreamKey]:
+        now = time.monotonic()
+        return [key for key in self.keys if key.is_available(now)]
+
+    def paces_tokens(self) -> bool:
+        """Whether any key has a known token budget, i.e. whether requests need a token cost estimate."""
+        return RATE_LIMIT_SCHEDULING and any(key.token_budget.limit is not None for key in self.keys)
+
+    def acquire(self, token_cost: int = 0) -> UpstreamKey:
+        """Pick a key for one upstream attempt; release() must be called when the attempt is done."""
+        candidates = self.available()
+        if not candidates:
+            # Every key is resting; use the one that recovers first rather than refusing the request
+            candidates = [min(self.keys, key=lambda key: key.cooldown_until)]
+        if len(candidates) > 1 and RATE_LIMIT_SCHEDULING:
+            # Prefer keys with rate-limit budget to spare; otherwise the one whose budget frees up first
+            waits = {id(key): key.budget_wait(token_cost) for key in candidates}
+            ready = [key for key in candidates if waits[id(key)] == 0]
+            candidates = ready or [min(candidates, key=lambda key: waits[id(key)])]
+        if KEY_SELECTION == "ewma":
+            # Weight latency by load so one fast key is not flooded; untried keys (no latency yet) go first
+            key = min(candidates, key=lambda key: ((key.latency or 0.0) * (key.outstanding + 1), key.requests))
+        else:
+            key = min(candidates, key=lambda key: (key.outstanding, key.requests))
+        key.outstanding += 1
+        key.requests += 1
+        metrics.inc("ccp_key_requests_total", provider=self.provider, key=key.label)
+        return key
+
+    def record(self, key: UpstreamKey, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        """Feed an attempt's latency, or its error, back into the key's state."""
+        if error is not None:
+            key.sync_rate_limits(get_error_headers(error))
+        if latency is not None:
+            key.latency = latency if key.latency is None else KEY_EWMA_ALPHA * latency + (1 - KEY_EWMA_ALPHA) * key.latency
+        if error is None or not isinstance(error, Exception):
+            return
+        key.errors += 1
+        status_code = get_status_code(error)
+        if status_code == 429:
+            cooldown = get_retry_after(error) or KEY_RATE_LIMIT_COOLDOWN
+            reason = "rate_limited"
+        elif status_code in (401, 403):
+            cooldown = KEY_AUTH_COOLDOWN
+            reason = "auth"
+        else:
+            return
+        if len(self.keys) > 1:
+            key.cooldown_until = time.monotonic() + cooldown
+            metrics.inc("ccp_key_cooldowns_total", provider=self.provider, key=key.label, reason=reason)
+            logger.warning(f"{self.provider} key {key.label} {reason}; resting it for {cooldown:.0f}s")
+
+    def release(self, key: UpstreamKey):
+        key.outstanding = max(0, key.outstanding - 1)
+
+def split_setting(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+def build_key_pool(provider: str, api_keys: Optional[str], api_bases: Optional[str]) -> KeyPool:
+    """Pair comma-separated keys with comma-separated API bases (one base may serve every key)."""
+    keys = split_setting(api_keys) or [None]
+    bases = split_setting(api_bases) or [None]
+    if len(bases) == 1:
+        bases = bases * len(keys)
+    elif len(keys) == 1:
+        keys = keys * len(bases)
+    elif len(keys) != len(bases):
+        logger.error(f"FATAL: {provider} has {len(keys)} API keys but {len(bases)} API bases; give one base or one per key.")
+        sys.exit(1)
+    return KeyPool(provider, [UpstreamKey(provider, key, base) for key, base in zip(keys, bases)])
+
+key_pools: Dict[str, KeyPool] = {
+    "openai": build_key_pool("openai", OPENAI_API_KEY, OPENAI_API_BASE),
+    "gemini": build_key_pool("gemini", GEMINI_API_KEY, GEMINI_API_BASE),
+    "anthropic": build_key_pool("anthropic", ANTHROPIC_API_KEY, ANTHROPIC_API_BASE),
+}
+
+def has_spare_key(provider: str) -> bool:
+    """True if another of the provider's keys is available right now."""
+    pool = key_pools.get(provider)
+    return pool is not None and len(pool.keys) > 1 and bool(pool.available())
+
+async def with_api_key(send: Callable[[Dict[str, Any]], Any], litellm_request: Dict[str, Any],
+                       ticket: "AdmissionTicket", hold_until_released: bool = False, token_cost: int = 0,
+                       semaphore: Optional[asyncio.Semaphore] = None):
+    """Await send() with credentials from the provider's key pool, pacing it to the key's rate limits.
+
+    With hold_until_released (streams), the key counts as busy until the ticket is released.
+    semaphore, if given, is held around send() and acquired before the call is timed.
+    """
+    provider = get_provider(litellm_request["model"])
+    pool = key_pools[provider]
+    key = pool.acquire(token_cost)
+    logger.debug(f"Using {provider} key {key.label} for model: {litellm_request['model']}")
+
+    wait = key.reserve_budget(token_cost)
+    if wait > 0:
+        if wait > RATE_LIMIT_MAX_WAIT:
+            key.refund_budget(token_cost)
+            pool.release(key)
+            metrics.inc("ccp_rate_limit_rejected_total", provider=provider)
+            raise RateLimitBudgetError(f"Rate limit budget for {litellm_request['model']} is exhausted for {wait:.0f}s")
+        metrics.observe("ccp_rate_limit_wait_seconds", wait, provider=provider)
+        try:
+            await asyncio.sleep(wait)
+        except BaseException:
+            key.refund_budget(token_cost)
+            pool.release(key)
+            raise
+
+    attempt = dict(litellm_request)
+    attempt["api_key"] = key.api_key
+    if key.api_base:
+        attempt["api_base"] = key.api_base
+    # Route the call through the shared, long-lived connection pool for this key's API base
+    attempt["client"] = await upstream_pool.litellm_client(provider, key.api_key, key.api_base)
+
+    if semaphore is not None:
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            key.refund_budget(token_cost)
+            pool.release(key)
+            raise
+    start_time = time.monotonic()
+    try:
+        result = await send(attempt)
+    except BaseException as e:
+        pool.record(key, error=e)
+        pool.release(key)
+        raise
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+        elapsed = upstream_elapsed.get(None)
+        if elapsed is not None:
+            elapsed[0] += time.monotonic() - start_time
+    key.sync_rate_limits(get_response_headers(result))
+    pool.record(key, latency=time.monotonic() - start_time)
+    if hold_until_released:
+        ticket.on_release(lambda: pool.release(key))
+    else:
+        pool.release(key)
+    return result
+
+metrics.gauge("ccp_key_outstanding", lambda: [
+    ({"provider": pool.provider, "key": key.label}, key.outstanding)
+    for pool in key_pools.values() for key in pool.keys
+])
+metrics.gauge("ccp_key_available", lambda: [
+    ({"provider": pool.provider, "key": key.label}, int(key.is_available(time.monotonic())))
+    for pool in key_pools.values() for key in pool.keys
+])
+
+async def close_upstream_stream(response_generator):
+    """Close a LiteLLM stream so the upstream generation is cancelled and its connection released."""
+    aclose = getattr(response_generator, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        logger.debug(f"Error closing upstream stream: {e}")
+
+class LazyUpstreamStream:
+    """An upstream stream that only connects when first iterated, so the client's stream can start at once.
+
+    open_upstream() returns the opened stream and the admission ticket to release when it is closed.
+    """
+
+    def __init__(self, open_upstream: Callable[[], Awaitable[Tuple[Any, AdmissionTicket]]]):
+        self.open_upstream = open_upstream
+        self.response_generator = None
+        self.ticket: Optional[AdmissionTicket] = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.response_generator is None:
+            self.response_generator, self.ticket = await self.open_upstream()
+        return await self.response_generator.__anext__()
+
+    async def aclose(self):
+        try:
+            if self.response_generator is not None:
+                await close_upstream_stream(self.response_generator)
+        finally:
+            if self.ticket is not None:
+                self.ticket.release()
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that always closes its body iterator, even when the client disconnects mid-stream.
+
+    Starlette stops iterating on disconnect but leaves a suspended generator to the garbage
+    collector; closing it here runs the generators' cleanup (and closes the upstream) at once.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await asyncio.shield(aclose())
+
 # Helper function to clean schema for Gemini
 def clean_gemini_schema(schema: Any) -> Any:
-    """Recursively removes unsupported fields from a JSON schema for Gemini."""
+    """Recursively removes unsupported fields from a JSON schema for Gemini, returning a new schema."""
     if isinstance(schema, dict):
-        # Remove specific keys unsupported by Gemini tool parameters
-        schema.pop("additionalProperties", None)
-        schema.pop("default", None)
-
-        # Check for unsupported 'format' in string types
-        if schema.get("type") == "string" and "format" in schema:
-            allowed_formats = {"enum", "date-time"}
-            if schema["format"] not in allowed_formats:
-                logger.debug(f"Removing unsupported format '{schema['format']}' for string type in Gemini schema.")
-                schema.pop("format")
-
-        # Recursively clean nested schemas (properties, items, etc.)
-        for key, value in list(schema.items()): # Use list() to allow modification during iteration
-            schema[key] = clean_gemini_schema(value)
+        cleaned = {}
+        for key, value in schema.items():
+            # Remove specific keys unsupported by Gemini tool parameters
+            if key in ("additionalProperties", "default"):
+                continue
+            # Check for unsupported 'format' in string types
+            if key == "format" and schema.get("type") == "string" and value not in ("enum", "date-time"):
+                logger.debug(f"Removing unsupported format '{value}' for string type in Gemini schema.")
+                continue
+            # Recursively clean nested schemas (properties, items, etc.)
+            cleaned[key] = clean_gemini_schema(value)
+        return cleaned
     elif isinstance(schema, list):
         # Recursively clean items in a list
         return [clean_gemini_schema(item) for item in schema]
     return schema
 
 # Models for Anthropic API requests
+# Prompt-caching breakpoint ({"type": "ephemeral"}); request-only, so it is left out of responses
+CacheControl = Optional[Dict[str, Any]]
+
 class ContentBlockText(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class ContentBlockImage(BaseModel):
     type: Literal["image"]
     source: Dict[str, Any]
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class ContentBlockToolUse(BaseModel):
     type: Literal["tool_use"]
     id: str
     name: str
     input: Dict[str, Any]
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class ContentBlockToolResult(BaseModel):
     type: Literal["tool_result"]
     tool_use_id: str
     content: Union[str, List[Dict[str, Any]], Dict[str, Any], List[Any], Any]
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class SystemContent(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class Message(BaseModel):
     role: Literal["user", "assistant"] 
@@ -176,6 +1455,7 @@ class Tool(BaseModel):
     name: str
     description: Optional[str] = None
     input_schema: Dict[str, Any]
+    cache_control: CacheControl = Field(default=None, exclude=True)
 
 class ThinkingConfig(BaseModel):
     enabled: Optional[bool] = None
@@ -197,6 +1477,7 @@ class MessagesRequest(BaseModel):
     tool_choice: Optional[Dict[str, Any]] = None
     thinking: Optional[ThinkingConfig] = None
     original_model: Optional[str] = None  # Will store the original model name
+    _caller: Optional[str] = PrivateAttr(default=None)  # caller_hash of the client that sent it
     
     @field_validator('model')
     def validate_model_field(cls, v, info): # Renamed to avoid conflict
@@ -216,23 +1497,16 @@ class MessagesRequest(BaseModel):
 
         # --- Mapping Logic --- START ---
         mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
+        # Map Haiku to the first SMALL_MODEL in its chain
+        # (the chain is already prefixed based on provider preference)
         if 'haiku' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google":
-                new_model = f"gemini/{SMALL_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{SMALL_MODEL}"
-                mapped = True
+            new_model = SMALL_MODEL_CHAIN[0]
+            mapped = True
 
-        # Map Sonnet to BIG_MODEL based on provider preference
+        # Map Sonnet to the first BIG_MODEL in its chain
         elif 'sonnet' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google":
-                new_model = f"gemini/{BIG_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{BIG_MODEL}"
-                mapped = True
+            new_model = BIG_MODEL_CHAIN[0]
+            mapped = True
 
         # Add prefixes to non-mapped models if they match known lists
         elif not mapped:
@@ -289,23 +1563,16 @@ class TokenCountRequest(BaseModel):
 
         # --- Mapping Logic --- START ---
         mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
+        # Map Haiku to the first SMALL_MODEL in its chain
+        # (the chain is already prefixed based on provider preference)
         if 'haiku' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google":
-                new_model = f"gemini/{SMALL_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{SMALL_MODEL}"
-                mapped = True
+            new_model = SMALL_MODEL_CHAIN[0]
+            mapped = True
 
-        # Map Sonnet to BIG_MODEL based on provider preference
+        # Map Sonnet to the first BIG_MODEL in its chain
         elif 'sonnet' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google":
-                new_model = f"gemini/{BIG_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{BIG_MODEL}"
-                mapped = True
+            new_model = BIG_MODEL_CHAIN[0]
+            mapped = True
 
         # Add prefixes to non-mapped models if they match known lists
         elif not mapped:
@@ -366,6 +1633,99 @@ async def log_requests(request: Request, call_next):
 
 # Not using validation function as we're using the environment API key
 
+# --- Canonical Serialization ---
+# Serialize tool inputs, tool results and tool schemas with sorted keys, so that earlier turns of a
+# conversation convert to byte-identical text and keep hitting the providers' prompt prefix caches
+CANONICAL_REQUESTS = os.environ.get("CANONICAL_REQUESTS", "true").lower() == "true"
+
+def canonical_json(value) -> str:
+    """json.dumps that, in canonical mode, always gives the same text for equal values."""
+    return json.dumps(value, sort_keys=CANONICAL_REQUESTS)
+
+def canonical_value(value):
+    """Return value with every dict's keys in sorted order (unchanged outside canonical mode); never mutates it."""
+    if not CANONICAL_REQUESTS:
+        return value
+    if isinstance(value, dict):
+        return {key: canonical_value(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [canonical_value(item) for item in value]
+    return value
+
+# Log how much of each prompt is byte-identical to the previous request of the same session
+PREFIX_DIAGNOSTICS = os.environ.get("PREFIX_DIAGNOSTICS", "false").lower() == "true"
+PREFIX_DIAGNOSTICS_SESSIONS = int(os.environ.get("PREFIX_DIAGNOSTICS_SESSIONS", "256"))
+
+def caller_hash(request, raw_request: Request) -> str:
+    """Hash of the calling client: its API key (x-api-key or Authorization) and metadata.user_id."""
+    credential = raw_request.headers.get("x-api-key") or raw_request.headers.get("authorization") or ""
+    caller = f"{credential}\n{(request.metadata or {}).get('user_id') or ''}"
+    return hashlib.sha256(caller.encode("utf-8")).hexdigest()
+
+def get_session_id(request, raw_request: Request) -> Optional[str]:
+    """Identify the client session: Claude Code's session header, or the user_id it puts in metadata."""
+    return raw_request.headers.get("x-claude-code-session-id") or (request.metadata or {}).get("user_id")
+
+class PrefixTracker:
+    """Compares each converted request with the previous one of its session to find the longest stable prefix.
+
+    Only a hash and length per prompt segment (the tools, then each message) is kept,
+    so the prefix is measured in whole segments.
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, List[Tuple[bytes, int]]]" = OrderedDict()
+        self.last: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def segments(litellm_request: Dict[str, Any]) -> List[Tuple[bytes, int]]:
+        parts = [litellm_request.get("tools") or []] + list(litellm_request.get("messages", []))
+        # Keys in the order the request is sent: a reordering breaks the provider's prefix cache too
+        encoded = [json.dumps(part, default=str).encode("utf-8") for part in parts]
+        return [(hashlib.sha256(part).digest(), len(part)) for part in encoded]
+
+    def observe(self, session: str, litellm_request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Record a request and return its prefix report, or None for the first request of a session."""
+        current = self.segments(litellm_request)
+        previous = self.sessions.pop(session, None)
+        self.sessions[session] = current
+        while len(self.sessions) > self.max_sessions:
+            evicted, _ = self.sessions.popitem(last=False)
+            self.last.pop(evicted, None)
+        if previous is None:
+            return None
+
+        stable = 0
+        changed_at = None
+        for index, (old, new) in enumerate(zip(previous, current)):
+            if old[0] != new[0]:
+                changed_at = index
+                break
+            stable += new[1]
+        else:
+            if len(previous) > len(current):
+                # The history got shorter (e.g. compacted)
+                changed_at = len(current)
+        previous_bytes = sum(length for _, length in previous)
+        report = {
+            "stable_bytes": stable,
+            "previous_bytes": previous_bytes,
+            "stable_ratio": round(stable / previous_bytes, 4) if previous_bytes else 1.0,
+            # 'tools' or the index of the first message that changed; None if the previous prompt was kept whole
+            "first_change": None if changed_at is None else ("tools" if changed_at == 0 else f"message {changed_at - 1}"),
+        }
+        self.last[session] = report
+        metrics.inc("ccp_prompt_prefix_bytes_total", stable, part="stable")
+        metrics.inc("ccp_prompt_prefix_bytes_total", previous_bytes - stable, part="changed")
+        if changed_at is not None:
+            metrics.inc("ccp_prompt_prefix_breaks_total", segment="tools" if changed_at == 0 else "messages")
+            logger.info(f"Prompt prefix changed at {report['first_change']}: "
+                        f"{stable} of {previous_bytes} bytes stable ({report['stable_ratio']:.1%})")
+        return report
+
+prefix_tracker = PrefixTracker(PREFIX_DIAGNOSTICS_SESSIONS)
+
 def parse_tool_result_content(content):
     """Helper function to properly parse and normalize tool result content."""
     if content is None:
@@ -386,36 +1746,516 @@ def parse_tool_result_content(content):
                     result += item.get("text", "") + "\n"
                 else:
                     try:
-                        result += json.dumps(item) + "\n"
+                        result += canonical_json(item) + "\n"
                     except:
                         result += str(item) + "\n"
             else:
-                try:
-                    result += str(item) + "\n"
-                except:
-                    result += "Unparseable content\n"
-        return result.strip()
-        
-    if isinstance(content, dict):
-        if content.get("type") == "text":
-            return content.get("text", "")
-        try:
-            return json.dumps(content)
-        except:
-            return str(content)
-            
-    # Fallback for any other type
-    try:
-        return str(content)
-    except:
-        return "Unparseable content"
+                try:
+                    result += str(item) + "\n"
+                except:
+                    result += "Unparseable content\n"
+        return result.strip()
+        
+    if isinstance(content, dict):
+        if content.get("type") == "text":
+            return content.get("text", "")
+        try:
+            return canonical_json(content)
+        except:
+            return str(content)
+            
+    # Fallback for any other type
+    try:
+        return str(content)
+    except:
+        return "Unparseable content"
+
+def supports_cache_control(model: str) -> bool:
+    """Whether cache_control breakpoints are passed on for this model (OpenAI caches prefixes automatically)."""
+    return model.split("/", 1)[0] in PROMPT_CACHE_PROVIDERS
+
+def with_cache_control(block: Dict[str, Any], source) -> Dict[str, Any]:
+    """Copy an Anthropic block's cache_control breakpoint, if any, onto its converted form."""
+    if getattr(source, "cache_control", None):
+        block["cache_control"] = source.cache_control
+    return block
+
+def anthropic_usage(usage_info) -> Dict[str, int]:
+    """Map OpenAI-style usage (object or dict) to Anthropic's, splitting prompt-cache reads and writes out of the input."""
+    def field(source, name):
+        value = source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+        return value if isinstance(value, int) else 0
+
+    details = None
+    if usage_info is not None:
+        details = usage_info.get("prompt_tokens_details") if isinstance(usage_info, dict) else getattr(usage_info, "prompt_tokens_details", None)
+    cache_read = (field(details, "cached_tokens") if details else 0) or field(usage_info, "cache_read_input_tokens")
+    cache_creation = (field(details, "cache_write_tokens") if details else 0) or field(usage_info, "cache_creation_input_tokens")
+    # prompt_tokens counts cached tokens too; Anthropic's input_tokens does not
+    return {
+        "input_tokens": max(0, field(usage_info, "prompt_tokens") - cache_read - cache_creation),
+        "output_tokens": field(usage_info, "completion_tokens"),
+        "cache_creation_input_tokens": cache_creation,
+        "cache_read_input_tokens": cache_read,
+    }
+
+def record_prompt_cache_usage(model: str, usage: Dict[str, int]):
+    for cache, key in (("read", "cache_read_input_tokens"), ("write", "cache_creation_input_tokens"), ("none", "input_tokens")):
+        if usage.get(key):
+            metrics.inc("ccp_input_tokens_total", usage[key], model=model, cache=cache)
+
+# --- Conversion Cache ---
+# Memory budget for the conversions kept for incremental reuse (0 disables the cache)
+CONVERSION_CACHE_MAX_BYTES = int(os.environ.get("CONVERSION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class ConversionCache:
+    """Each session's last converted history, so a resent conversation only converts its new messages.
+
+    A session is identified by its metadata.user_id, its first message and the target dialect. The
+    reusable prefix is found by comparing messages with those of the previous request, which is
+    much cheaper than converting them again (or serializing them to hash). Sessions are evicted
+    least recently used first; sizes are estimated from the converted content.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.reused = 0
+        self.converted = 0
+        # session key -> (source messages, converted messages of each, estimated size of each, digests of
+        # the converted messages, filled in on demand), least recently used first
+        self.sessions: "OrderedDict[Tuple, Tuple[List[Message], List[List[Dict[str, Any]]], List[int], List[List[bytes]]]]" = OrderedDict()
+
+    @staticmethod
+    def estimate_size(converted: List[Dict[str, Any]]) -> int:
+        size = 0
+        for message in converted:
+            content = message.get("content")
+            if isinstance(content, str):
+                size += len(content)
+            elif content is not None:
+                size += len(json.dumps(content, default=str))
+            for tool_call in message.get("tool_calls", ()):
+                size += len(tool_call["function"]["arguments"])
+        # The source message is kept as well
+        return 2 * size
+
+    @staticmethod
+    def session_key(request: MessagesRequest, dialect: str) -> Tuple:
+        # Scoped to the caller, so clients sharing an opening message never share (or evict) a session
+        first = request.messages[0]
+        return (dialect, request._caller, (request.metadata or {}).get("user_id"), first.__pydantic_serializer__.to_json(first))
+
+    def convert(self, request: MessagesRequest, dialect: str,
+                convert: Callable[[Message], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Convert request.messages, reusing the previous conversion of the session's unchanged prefix.
+
+        Callers get their own top-level dicts; nested values are shared and must not be modified.
+        """
+        messages = request.messages
+        if self.max_bytes <= 0 or not messages:
+            return [message for msg in messages for message in convert(msg)]
+
+        key = self.session_key(request, dialect)
+        previous = self.sessions.pop(key, None)
+        reused = 0
+        converted: List[List[Dict[str, Any]]] = []
+        sizes: List[int] = []
+        digests: List[List[bytes]] = []
+        if previous is not None:
+            previous_messages, previous_converted, previous_sizes, previous_digests = previous
+            self.size -= sum(previous_sizes)
+            limit = min(len(previous_messages), len(messages))
+            while reused < limit and messages[reused] == previous_messages[reused]:
+                reused += 1
+            converted = previous_converted[:reused]
+            sizes = previous_sizes[:reused]
+            digests = previous_digests[:reused]
+        for msg in messages[reused:]:
+            group = convert(msg)
+            converted.append(group)
+            sizes.append(self.estimate_size(group))
+
+        self.reused += reused
+        self.converted += len(messages) - reused
+        metrics.inc("ccp_conversion_cache_messages_total", reused, result="hit")
+        metrics.inc("ccp_conversion_cache_messages_total", len(messages) - reused, result="miss")
+
+        size = sum(sizes)
+        if size <= self.max_bytes // 8:
+            self.sessions[key] = (list(messages), converted, sizes, digests)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_sizes, _) = self.sessions.popitem(last=False)
+                self.size -= sum(evicted_sizes)
+                metrics.inc("ccp_conversion_cache_evictions_total")
+        return [dict(message) for group in converted for message in group]
+
+    def latest(self, request: MessagesRequest, dialect: str) -> Optional[Tuple]:
+        """The session entry holding request's conversion, if it is the session's latest one."""
+        if self.max_bytes <= 0 or not request.messages:
+            return None
+        entry = self.sessions.get(self.session_key(request, dialect))
+        if entry is None or len(entry[0]) != len(request.messages) or entry[0][-1] is not request.messages[-1]:
+            return None
+        return entry
+
+    def converted_chars(self, request: MessagesRequest, dialect: str) -> Optional[int]:
+        """Estimated characters of request's converted messages, if they are its session's latest conversion."""
+        entry = self.latest(request, dialect)
+        # Sizes count the source message as well
+        return sum(entry[2]) // 2 if entry is not None else None
+
+    def message_digests(self, request: MessagesRequest, dialect: str) -> Optional[List[bytes]]:
+        """Digests of request's converted messages, hashing only those the session has not hashed yet."""
+        entry = self.latest(request, dialect)
+        if entry is None:
+            return None
+        _, converted, _, digests = entry
+        for group in converted[len(digests):]:
+            digests.append([message_digest(message) for message in group])
+        return [digest for group in digests for digest in group]
+
+    def clear(self):
+        self.sessions.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.reused + self.converted
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hit_ratio": round(self.reused / total, 4) if total else None,
+        }
+
+conversion_cache = ConversionCache(CONVERSION_CACHE_MAX_BYTES)
+metrics.gauge("ccp_conversion_cache_bytes", lambda: [({}, conversion_cache.size)])
+
+# --- Tool Definition Cache ---
+# Translated tool definitions kept per schema and target provider (0 disables the cache)
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", "256"))
+
+class ToolDefinitionCache:
+    """Translated function definitions, keyed by the serialized Anthropic tool and the target dialect.
+
+    Clients resend the same tool set with every request, so each definition is translated once and
+    the pre-built dict is shared by every later request; callers must not modify it. The exception is
+    Gemini: LiteLLM rewrites its parameter schemas in place, so those are kept as JSON text and every
+    request gets a freshly decoded copy.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # (dialect, serialized tool, cache_control) -> definition (JSON text for Gemini), least recently used first
+        self.entries: "OrderedDict[Tuple[str, bytes, Optional[str]], Union[Dict[str, Any], str]]" = OrderedDict()
+
+    def convert(self, tools: List[Tool], dialect: str, carry_cache_control: bool,
+                convert: Callable[[Tool], Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if self.max_entries <= 0:
+            return [convert(tool) for tool in tools]
+
+        decode = dialect.startswith("gemini")
+        definitions = []
+        hits = 0
+        for tool in tools:
+            # cache_control is excluded from serialization, but changes the definition
+            marker = json.dumps(tool.cache_control, sort_keys=True) if carry_cache_control and tool.cache_control else None
+            key = (dialect, tool.__pydantic_serializer__.to_json(tool), marker)
+            entry = self.entries.get(key)
+            if entry is None:
+                # Round-trip through JSON so the entry shares nothing with the caller's schema
+                entry = json.dumps(convert(tool))
+                if not decode:
+                    entry = json.loads(entry)
+                self.entries[key] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+                hits += 1
+            definitions.append(json.loads(entry) if decode else entry)
+
+        self.hits += hits
+        self.misses += len(tools) - hits
+        metrics.inc("ccp_tool_cache_requests_total", hits, result="hit")
+        metrics.inc("ccp_tool_cache_requests_total", len(tools) - hits, result="miss")
+        return definitions
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+tool_cache = ToolDefinitionCache(TOOL_CACHE_SIZE)
+
+def convert_tool(tool: Tool, is_gemini_model: bool, carry_cache_control: bool) -> Dict[str, Any]:
+    """Convert one Anthropic tool to an OpenAI-style function definition; the tool is left unchanged."""
+    # Clean the schema if targeting a Gemini model
+    input_schema = canonical_value(tool.input_schema)
+    if is_gemini_model:
+        logger.debug(f"Cleaning schema for Gemini tool: {tool.name}")
+        input_schema = clean_gemini_schema(input_schema)
+
+    # Create OpenAI-compatible function tool
+    openai_tool = {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": input_schema # Use potentially cleaned schema
+        }
+    }
+    # Gemini's context caching only looks at messages
+    if carry_cache_control and not is_gemini_model and tool.cache_control:
+        openai_tool["cache_control"] = tool.cache_control
+    return openai_tool
+
+def append_tool_result_items(parts: List[str], items: List[Any]):
+    """Append the text of a tool_result content list: text items as they are, other objects as JSON."""
+    for item in items:
+        if isinstance(item, dict):
+            if item.get("type") == "text" or "text" in item:
+                parts.append(item.get("text", ""))
+            else:
+                try:
+                    parts.append(canonical_json(item))
+                except:
+                    parts.append(str(item))
+            parts.append("\n")
+
+def append_tool_result_text(parts: List[str], result: Any):
+    """Append the text of a tool_result's content, whatever form it came in."""
+    if isinstance(result, str):
+        parts.append(result)
+    elif isinstance(result, list):
+        append_tool_result_items(parts, result)
+    elif isinstance(result, dict):
+        if result.get("type") == "text":
+            parts.append(result.get("text", ""))
+        else:
+            try:
+                parts.append(canonical_json(result))
+            except:
+                parts.append(str(result))
+    else:
+        try:
+            parts.append(str(result))
+        except:
+            parts.append("Unparseable content")
+
+def tool_result_message_parts(content: List[Any]) -> List[str]:
+    """The text of a user message carrying tool results, as parts to join."""
+    parts = []
+    for block in content:
+        if block.type == "text":
+            parts.append(block.text)
+            parts.append("\n")
+        elif block.type == "tool_result":
+            # In OpenAI format, tool results come from the user (rather than being content blocks)
+            parts.append(f"Tool result for {block.tool_use_id}:\n")
+            append_tool_result_text(parts, block.content)
+            parts.append("\n")
+    return parts
+
+def append_tool_result_content(parts: List[str], content: Any):
+    """Append a tool_result's content the way flattened OpenAI messages show it."""
+    if isinstance(content, str):
+        parts.append(content)
+        parts.append("\n")
+    elif isinstance(content, list):
+        append_tool_result_items(parts, content)
+    else:
+        parts.append(str(content))
+        parts.append("\n")
+
+def convert_message(msg: Message, carry_cache_control: bool) -> Dict[str, Any]:
+    """Convert one Anthropic message to its LiteLLM (OpenAI-style) message, keeping content blocks."""
+    content = msg.content
+    if isinstance(content, str):
+        return {"role": msg.role, "content": content}
+    else:
+        # Special handling for tool_result in user messages
+        # OpenAI/LiteLLM format expects the assistant to call the tool, 
+        # and the user's next message to include the result as plain text
+        if msg.role == "user" and any(block.type == "tool_result" for block in content):
+            # Add as a single user message with all the content
+            text_content = "".join(tool_result_message_parts(content)).strip()
+            markers = [block.cache_control for block in content if block.cache_control]
+            if carry_cache_control and markers:
+                # Claude Code marks the newest tool result; keep that breakpoint on the flattened text
+                return {"role": "user", "content": [
+                    {"type": "text", "text": text_content, "cache_control": markers[-1]}
+                ]}
+            else:
+                return {"role": "user", "content": text_content}
+        else:
+            # Regular handling for other message types
+            processed_content = []
+            for block in content:
+                if hasattr(block, "type"):
+                    if block.type == "text":
+                        processed_content.append({"type": "text", "text": block.text})
+                    elif block.type == "image":
+                        processed_content.append({"type": "image", "source": block.source})
+                    elif block.type == "tool_use":
+                        # Handle tool use blocks if needed
+                        processed_content.append({
+                            "type": "tool_use",
+                            "id": block.id,
+                            "name": block.name,
+                            "input": canonical_value(block.input)
+                        })
+                    elif block.type == "tool_result":
+                        # Handle different formats of tool result content
+                        processed_content_block = {
+                            "type": "tool_result",
+                            "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
+                        }
+    
+                        # Process the content field properly
+                        if hasattr(block, "content"):
+                            if isinstance(block.content, str):
+                                # If it's a simple string, create a text block for it
+                                processed_content_block["content"] = [{"type": "text", "text": block.content}]
+                            elif isinstance(block.content, list):
+                                # If it's already a list of blocks, keep it
+                                processed_content_block["content"] = canonical_value(block.content)
+                            else:
+                                # Default fallback
+                                processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
+                        else:
+                            # Default empty content
+                            processed_content_block["content"] = [{"type": "text", "text": ""}]
+    
+                        processed_content.append(processed_content_block)
+    
+                    if carry_cache_control and processed_content and block.cache_control:
+                        with_cache_control(processed_content[-1], block)
+    
+            return {"role": msg.role, "content": processed_content}
+
+def convert_openai_message(msg: Message, carry_cache_control: bool) -> Dict[str, Any]:
+    """Convert one Anthropic message straight to what OpenAI models accept: plain string content.
+
+    A single pass over the blocks; OpenAI messages never carry content blocks or extra fields.
+    """
+    content = msg.content
+    if isinstance(content, str):
+        return {"role": msg.role, "content": content}
+
+    if msg.role == "user" and any(block.type == "tool_result" for block in content):
+        text_content = "".join(tool_result_message_parts(content)).strip()
+        if not text_content and carry_cache_control and any(block.cache_control for block in content):
+            # The breakpoint's text block is never sent empty
+            text_content = "..."
+        return {"role": "user", "content": text_content}
+
+    parts = []
+    if content and all(block.type == "tool_result" for block in content):
+        logger.warning(f"Found message with only tool_result content - special handling required")
+        for block in content:
+            parts.append("Tool Result:\n")
+            append_tool_result_content(parts, block.content)
+        text_content = "".join(parts).strip()
+        logger.warning(f"Converted tool_result to plain text: {text_content[:200]}...")
+        return {"role": msg.role, "content": text_content or "..."}
+
+    for block in content:
+        if block.type == "text":
+            parts.append(block.text)
+            parts.append("\n")
+        elif block.type == "tool_result":
+            parts.append(f"[Tool Result ID: {block.tool_use_id}]\n")
+            append_tool_result_content(parts, block.content)
+        elif block.type == "tool_use":
+            parts.append(f"[Tool: {block.name} (ID: {block.id})]\nInput: {canonical_json(block.input)}\n\n")
+        elif block.type == "image":
+            parts.append("[Image content - not displayed in text format]\n")
+
+    # Make sure content is never empty for OpenAI models
+    return {"role": msg.role, "content": "".join(parts).strip() or "..."}
+
+def convert_tool_call_message(msg: Message, carry_cache_control: bool, flatten: bool) -> List[Dict[str, Any]]:
+    """Convert one Anthropic message using OpenAI's native tool calling.
+
+    tool_use blocks become the assistant's tool_calls and every tool_result its own "tool"
+    message, which LiteLLM translates into each provider's tool format. Any other blocks are
+    converted as usual (see convert_message and convert_openai_message).
+    """
+    convert_rest = convert_openai_message if flatten else convert_message
+    content = msg.content
+    if isinstance(content, str):
+        return [convert_rest(msg, carry_cache_control)]
+
+    if msg.role == "assistant" and any(block.type == "tool_use" for block in content):
+        tool_calls = []
+        rest = []
+        for block in content:
+            if block.type == "tool_use":
+                tool_call = {
+                    "id": block.id,
+                    "type": "function",
+                    "function": {"name": block.name, "arguments": canonical_json(block.input)},
+                }
+                if carry_cache_control and block.cache_control:
+                    tool_call["cache_control"] = block.cache_control
+                tool_calls.append(tool_call)
+            else:
+                rest.append(block)
+        if rest:
+            message = convert_rest(msg.model_copy(update={"content": rest}), carry_cache_control)
+        else:
+            # An assistant turn that only calls tools has no content
+            message = {"role": "assistant", "content": None}
+        message["tool_calls"] = tool_calls
+        return [message]
+
+    if msg.role == "user" and any(block.type == "tool_result" for block in content):
+        # Tool messages must directly follow the assistant's tool calls, so other blocks come after them
+        messages = []
+        rest = []
+        for block in content:
+            if block.type == "tool_result":
+                parts = []
+                append_tool_result_text(parts, block.content)
+                if parts and parts[-1] == "\n":
+                    parts.pop()
+                tool_message = {"role": "tool", "tool_call_id": block.tool_use_id, "content": "".join(parts)}
+                if carry_cache_control and block.cache_control:
+                    tool_message["cache_control"] = block.cache_control
+                messages.append(tool_message)
+            else:
+                rest.append(block)
+        if rest:
+            messages.append(convert_rest(msg.model_copy(update={"content": rest}), carry_cache_control))
+        return messages
+
+    return [convert_rest(msg, carry_cache_control)]
+
+def message_dialect(flatten: bool, carry_cache_control: bool) -> str:
+    """The form converted messages take, which the conversion cache keeps them under."""
+    return ("openai" if flatten else "blocks") + ("+tools" if NATIVE_TOOL_CALLS else "") + ("+cache_control" if carry_cache_control else "")
 
-def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
-    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI)."""
+def convert_anthropic_to_litellm(anthropic_request: MessagesRequest, flatten: bool = False) -> Dict[str, Any]:
+    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI).
+
+    With flatten, message content is reduced to the plain strings OpenAI models require.
+    """
     # LiteLLM already handles Anthropic models when using the format model="anthropic/claude-3-opus-20240229"
     # So we just need to convert our Pydantic model to a dict in the expected format
     
     messages = []
+    # cache_control breakpoints are kept only for providers whose LiteLLM integration uses them
+    carry_cache_control = supports_cache_control(anthropic_request.model)
     
     # Add system message if present
     if anthropic_request.system:
@@ -423,6 +2263,15 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
         if isinstance(anthropic_request.system, str):
             # Simple string format
             messages.append({"role": "system", "content": anthropic_request.system})
+        elif flatten and carry_cache_control and any(block.cache_control for block in anthropic_request.system):
+            # OpenAI models take the system prompt as plain text
+            system_text = "".join(f"{block.text}\n" for block in anthropic_request.system).strip()
+            messages.append({"role": "system", "content": system_text or "..."})
+        elif carry_cache_control and any(block.cache_control for block in anthropic_request.system):
+            # Keep the blocks separate so each breakpoint stays where the client put it
+            messages.append({"role": "system", "content": [
+                with_cache_control({"type": "text", "text": block.text}, block) for block in anthropic_request.system
+            ]})
         elif isinstance(anthropic_request.system, list):
             # List of content blocks
             system_text = ""
@@ -435,112 +2284,15 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
             if system_text:
                 messages.append({"role": "system", "content": system_text.strip()})
     
-    # Add conversation messages
-    for idx, msg in enumerate(anthropic_request.messages):
-        content = msg.content
-        if isinstance(content, str):
-            messages.append({"role": msg.role, "content": content})
-        else:
-            # Special handling for tool_result in user messages
-            # OpenAI/LiteLLM format expects the assistant to call the tool, 
-            # and the user's next message to include the result as plain text
-            if msg.role == "user" and any(block.type == "tool_result" for block in content if hasattr(block, "type")):
-                # For user messages with tool_result, split into separate messages
-                text_content = ""
-                
-                # Extract all text parts and concatenate them
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            text_content += block.text + "\n"
-                        elif block.type == "tool_result":
-                            # Add tool result as a message by itself - simulate the normal flow
-                            tool_id = block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            
-                            # Handle different formats of tool result content
-                            result_content = ""
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    result_content = block.content
-                                elif isinstance(block.content, list):
-                                    # If content is a list of blocks, extract text from each
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "type") and content_block.type == "text":
-                                            result_content += content_block.text + "\n"
-                                        elif isinstance(content_block, dict) and content_block.get("type") == "text":
-                                            result_content += content_block.get("text", "") + "\n"
-                                        elif isinstance(content_block, dict):
-                                            # Handle any dict by trying to extract text or convert to JSON
-                                            if "text" in content_block:
-                                                result_content += content_block.get("text", "") + "\n"
-                                            else:
-                                                try:
-                                                    result_content += json.dumps(content_block) + "\n"
-                                                except:
-                                                    result_content += str(content_block) + "\n"
-                                elif isinstance(block.content, dict):
-                                    # Handle dictionary content
-                                    if block.content.get("type") == "text":
-                                        result_content = block.content.get("text", "")
-                                    else:
-                                        try:
-                                            result_content = json.dumps(block.content)
-                                        except:
-                                            result_content = str(block.content)
-                                else:
-                                    # Handle any other type by converting to string
-                                    try:
-                                        result_content = str(block.content)
-                                    except:
-                                        result_content = "Unparseable content"
-                            
-                            # In OpenAI format, tool results come from the user (rather than being content blocks)
-                            text_content += f"Tool result for {tool_id}:\n{result_content}\n"
-                
-                # Add as a single user message with all the content
-                messages.append({"role": "user", "content": text_content.strip()})
-            else:
-                # Regular handling for other message types
-                processed_content = []
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            processed_content.append({"type": "text", "text": block.text})
-                        elif block.type == "image":
-                            processed_content.append({"type": "image", "source": block.source})
-                        elif block.type == "tool_use":
-                            # Handle tool use blocks if needed
-                            processed_content.append({
-                                "type": "tool_use",
-                                "id": block.id,
-                                "name": block.name,
-                                "input": block.input
-                            })
-                        elif block.type == "tool_result":
-                            # Handle different formats of tool result content
-                            processed_content_block = {
-                                "type": "tool_result",
-                                "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            }
-                            
-                            # Process the content field properly
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    # If it's a simple string, create a text block for it
-                                    processed_content_block["content"] = [{"type": "text", "text": block.content}]
-                                elif isinstance(block.content, list):
-                                    # If it's already a list of blocks, keep it
-                                    processed_content_block["content"] = block.content
-                                else:
-                                    # Default fallback
-                                    processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
-                            else:
-                                # Default empty content
-                                processed_content_block["content"] = [{"type": "text", "text": ""}]
-                                
-                            processed_content.append(processed_content_block)
-                
-                messages.append({"role": msg.role, "content": processed_content})
+    # Add conversation messages, reusing earlier conversions of the same message
+    convert_one = convert_openai_message if flatten else convert_message
+
+    def convert(msg: Message) -> List[Dict[str, Any]]:
+        if NATIVE_TOOL_CALLS:
+            return convert_tool_call_message(msg, carry_cache_control, flatten)
+        return [convert_one(msg, carry_cache_control)]
+
+    messages.extend(conversion_cache.convert(anthropic_request, message_dialect(flatten, carry_cache_control), convert))
     
     # Cap max_tokens for OpenAI models to their limit of 16384
     max_tokens = anthropic_request.max_tokens
@@ -569,39 +2321,12 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     # Convert tools to OpenAI format
     if anthropic_request.tools:
-        openai_tools = []
         is_gemini_model = anthropic_request.model.startswith("gemini/")
-
-        for tool in anthropic_request.tools:
-            # Convert to dict if it's a pydantic model
-            if hasattr(tool, 'dict'):
-                tool_dict = tool.dict()
-            else:
-                # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
-                try:
-                    tool_dict = dict(tool) if not isinstance(tool, dict) else tool
-                except (TypeError, ValueError):
-                     logger.error(f"Could not convert tool to dict: {tool}")
-                     continue # Skip this tool if conversion fails
-
-            # Clean the schema if targeting a Gemini model
-            input_schema = tool_dict.get("input_schema", {})
-            if is_gemini_model:
-                 logger.debug(f"Cleaning schema for Gemini tool: {tool_dict.get('name')}")
-                 input_schema = clean_gemini_schema(input_schema)
-
-            # Create OpenAI-compatible function tool
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool_dict["name"],
-                    "description": tool_dict.get("description", ""),
-                    "parameters": input_schema # Use potentially cleaned schema
-                }
-            }
-            openai_tools.append(openai_tool)
-
-        litellm_request["tools"] = openai_tools
+        dialect = ("gemini" if is_gemini_model else "openai") + ("+cache_control" if carry_cache_control else "")
+        litellm_request["tools"] = tool_cache.convert(
+            anthropic_request.tools, dialect, carry_cache_control,
+            lambda tool: convert_tool(tool, is_gemini_model, carry_cache_control),
+        )
     
     # Convert tool_choice to OpenAI format if present
     if anthropic_request.tool_choice:
@@ -633,16 +2358,6 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
     
     # Enhanced response extraction with better error handling
     try:
-        # Get the clean model name to check capabilities
-        clean_model = original_request.model
-        if clean_model.startswith("anthropic/"):
-            clean_model = clean_model[len("anthropic/"):]
-        elif clean_model.startswith("openai/"):
-            clean_model = clean_model[len("openai/"):]
-        
-        # Check if this is a Claude model (which supports content blocks)
-        is_claude_model = clean_model.startswith("claude-")
-        
         # Handle ModelResponse object from LiteLLM
         if hasattr(litellm_response, 'choices') and hasattr(litellm_response, 'usage'):
             # Extract data from ModelResponse object directly
@@ -686,8 +2401,8 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
         if content_text is not None and content_text != "":
             content.append({"type": "text", "text": content_text})
         
-        # Add tool calls if present (tool_use in Anthropic format) - only for Claude models
-        if tool_calls and is_claude_model:
+        # Add tool calls if present (tool_use in Anthropic format), whichever model made them
+        if tool_calls:
             logger.debug(f"Processing tool calls: {tool_calls}")
             
             # Convert to list if it's not already
@@ -700,19 +2415,22 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                 # Extract function data based on whether it's a dict or object
                 if isinstance(tool_call, dict):
                     function = tool_call.get("function", {})
-                    tool_id = tool_call.get("id", f"tool_{uuid.uuid4()}")
+                    tool_id = tool_call.get("id")
                     name = function.get("name", "")
                     arguments = function.get("arguments", "{}")
                 else:
                     function = getattr(tool_call, "function", None)
-                    tool_id = getattr(tool_call, "id", f"tool_{uuid.uuid4()}")
+                    tool_id = getattr(tool_call, "id", None)
                     name = getattr(function, "name", "") if function else ""
                     arguments = getattr(function, "arguments", "{}") if function else "{}"
                 
+                # Claude Code needs an id to send the tool result back with
+                tool_id = tool_id or f"toolu_{uuid.uuid4().hex[:24]}"
+
                 # Convert string arguments to dict if needed
                 if isinstance(arguments, str):
                     try:
-                        arguments = json.loads(arguments)
+                        arguments = json_loads(arguments)
                     except json.JSONDecodeError:
                         logger.warning(f"Failed to parse tool arguments as JSON: {arguments}")
                         arguments = {"raw": arguments}
@@ -725,55 +2443,10 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                     "name": name,
                     "input": arguments
                 })
-        elif tool_calls and not is_claude_model:
-            # For non-Claude models, convert tool calls to text format
-            logger.debug(f"Converting tool calls to text for non-Claude model: {clean_model}")
-            
-            # We'll append tool info to the text content
-            tool_text = "\n\nTool usage:\n"
-            
-            # Convert to list if it's not already
-            if not isinstance(tool_calls, list):
-                tool_calls = [tool_calls]
-                
-            for idx, tool_call in enumerate(tool_calls):
-                # Extract function data based on whether it's a dict or object
-                if isinstance(tool_call, dict):
-                    function = tool_call.get("function", {})
-                    tool_id = tool_call.get("id", f"tool_{uuid.uuid4()}")
-                    name = function.get("name", "")
-                    arguments = function.get("arguments", "{}")
-                else:
-                    function = getattr(tool_call, "function", None)
-                    tool_id = getattr(tool_call, "id", f"tool_{uuid.uuid4()}")
-                    name = getattr(function, "name", "") if function else ""
-                    arguments = getattr(function, "arguments", "{}") if function else "{}"
-                
-                # Convert string arguments to dict if needed
-                if isinstance(arguments, str):
-                    try:
-                        args_dict = json.loads(arguments)
-                        arguments_str = json.dumps(args_dict, indent=2)
-                    except json.JSONDecodeError:
-                        arguments_str = arguments
-                else:
-                    arguments_str = json.dumps(arguments, indent=2)
-                
-                tool_text += f"Tool: {name}\nArguments: {arguments_str}\n\n"
-            
-            # Add or append tool text to content
-            if content and content[0]["type"] == "text":
-                content[0]["text"] += tool_text
-            else:
-                content.append({"type": "text", "text": tool_text})
         
         # Get usage information - extract values safely from object or dict
-        if isinstance(usage_info, dict):
-            prompt_tokens = usage_info.get("prompt_tokens", 0)
-            completion_tokens = usage_info.get("completion_tokens", 0)
-        else:
-            prompt_tokens = getattr(usage_info, "prompt_tokens", 0)
-            completion_tokens = getattr(usage_info, "completion_tokens", 0)
+        usage = anthropic_usage(usage_info)
+        record_prompt_cache_usage(original_request.model, usage)
         
         # Map OpenAI finish_reason to Anthropic stop_reason
         stop_reason = None
@@ -798,10 +2471,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             content=content,
             stop_reason=stop_reason,
             stop_sequence=None,
-            usage=Usage(
-                input_tokens=prompt_tokens,
-                output_tokens=completion_tokens
-            )
+            usage=Usage(**usage)
         )
         
         return anthropic_response
@@ -824,6 +2494,8 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
 
 async def handle_streaming(response_generator, original_request: MessagesRequest):
     """Handle streaming responses from LiteLLM and convert to Anthropic format."""
+    streamed_chars = 0  # Text and tool arguments generated so far
+    has_sent_stop_reason = False
     try:
         # Send message_start event
         message_id = f"msg_{uuid.uuid4().hex[:24]}"  # Format similar to Anthropic's IDs
@@ -846,13 +2518,13 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                 }
             }
         }
-        yield f"event: message_start\ndata: {json.dumps(message_data)}\n\n"
+        yield f"event: message_start\ndata: {json_dumps(message_data)}\n\n"
         
         # Content block index for the first text block
-        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
+        yield f"event: content_block_start\ndata: {json_dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
         
         # Send a ping to keep the connection alive (Anthropic does this)
-        yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
+        yield f"event: ping\ndata: {json_dumps({'type': 'ping'})}\n\n"
         
         tool_index = None
         current_tool_call = None
@@ -860,8 +2532,8 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
         accumulated_text = ""  # Track accumulated text content
         text_sent = False  # Track if we've sent any text content
         text_block_closed = False  # Track if text block is closed
-        input_tokens = 0
-        output_tokens = 0
+        usage = anthropic_usage(None)
+        stop_reason = "end_turn"
         has_sent_stop_reason = False
         last_tool_index = 0
         
@@ -872,10 +2544,11 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                 
                 # Check if this is the end of the response with usage data
                 if hasattr(chunk, 'usage') and chunk.usage is not None:
-                    if hasattr(chunk.usage, 'prompt_tokens'):
-                        input_tokens = chunk.usage.prompt_tokens
-                    if hasattr(chunk.usage, 'completion_tokens'):
-                        output_tokens = chunk.usage.completion_tokens
+                    usage = anthropic_usage(chunk.usage)
+
+                # After the finish reason only the usage chunk is still expected
+                if has_sent_stop_reason:
+                    continue
                 
                 # Handle text content
                 if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
@@ -903,11 +2576,12 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                     # Accumulate text content
                     if delta_content is not None and delta_content != "":
                         accumulated_text += delta_content
+                        streamed_chars += len(delta_content)
                         
                         # Always emit text deltas if no tool calls started
                         if tool_index is None and not text_block_closed:
                             text_sent = True
-                            yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})}\n\n"
+                            yield f"event: content_block_delta\ndata: {json_dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})}\n\n"
                     
                     # Process tool calls
                     delta_tool_calls = None
@@ -925,20 +2599,20 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             # If we've been streaming text, close that text block
                             if text_sent and not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
                             # If we've accumulated text but not sent it, we need to emit it now
                             # This handles the case where the first delta has both text and a tool call
                             elif accumulated_text and not text_sent and not text_block_closed:
                                 # Send the accumulated text
                                 text_sent = True
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield f"event: content_block_delta\ndata: {json_dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
                                 # Close the text block
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
                             # Close text block even if we haven't sent anything - models sometimes emit empty text blocks
                             elif not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
                                 
                         # Convert to list if it's not already
                         if not isinstance(delta_tool_calls, list):
@@ -970,9 +2644,10 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                                     function = getattr(tool_call, 'function', None)
                                     name = getattr(function, 'name', '') if function else ''
                                     tool_id = getattr(tool_call, 'id', f"toolu_{uuid.uuid4().hex[:24]}")
+                                tool_id = tool_id or f"toolu_{uuid.uuid4().hex[:24]}"
                                 
                                 # Start a new tool_use block
-                                yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
+                                yield f"event: content_block_start\ndata: {json_dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
                                 current_tool_call = tool_call
                                 tool_content = ""
                             
@@ -987,24 +2662,15 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             
                             # If we have arguments, send them as a delta
                             if arguments:
-                                # Try to detect if arguments are valid JSON or just a fragment
-                                try:
-                                    # If it's already a dict, use it
-                                    if isinstance(arguments, dict):
-                                        args_json = json.dumps(arguments)
-                                    else:
-                                        # Otherwise, try to parse it
-                                        json.loads(arguments)
-                                        args_json = arguments
-                                except (json.JSONDecodeError, TypeError):
-                                    # If it's a fragment, treat it as a string
-                                    args_json = arguments
+                                # Arguments arrive as JSON fragments, passed on as they are; a dict is serialized
+                                args_json = json_dumps(arguments) if isinstance(arguments, dict) else arguments
                                 
                                 # Add to accumulated tool content
                                 tool_content += args_json if isinstance(args_json, str) else ""
+                                streamed_chars += len(args_json) if isinstance(args_json, str) else 0
                                 
                                 # Send the update
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
+                                yield f"event: content_block_delta\ndata: {json_dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
                     
                     # Process finish_reason - end the streaming response
                     if finish_reason and not has_sent_stop_reason:
@@ -1013,15 +2679,15 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                         # Close any open tool call blocks
                         if tool_index is not None:
                             for i in range(1, last_tool_index + 1):
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                                yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': i})}\n\n"
                         
                         # If we accumulated text but never sent or closed text block, do it now
                         if not text_block_closed:
                             if accumulated_text and not text_sent:
                                 # Send the accumulated text
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield f"event: content_block_delta\ndata: {json_dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
                             # Close the text block
-                            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                            yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
                         
                         # Map OpenAI finish_reason to Anthropic stop_reason
                         stop_reason = "end_turn"
@@ -1031,18 +2697,7 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             stop_reason = "tool_use"
                         elif finish_reason == "stop":
                             stop_reason = "end_turn"
-                        
-                        # Send message_delta with stop reason and usage
-                        usage = {"output_tokens": output_tokens}
-                        
-                        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
-                        
-                        # Send message_stop event
-                        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
-                        
-                        # Send final [DONE] marker to match Anthropic's behavior
-                        yield "data: [DONE]\n\n"
-                        return
+                        # message_delta goes out once the stream ends, as usage may follow in a later chunk
             except Exception as e:
                 # Log error but continue processing other chunks
                 logger.error(f"Error processing chunk: {str(e)}")
@@ -1053,36 +2708,710 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
             # Close any open tool call blocks
             if tool_index is not None:
                 for i in range(1, last_tool_index + 1):
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                    yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': i})}\n\n"
             
             # Close the text content block
-            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
-            
-            # Send final message_delta with usage
-            usage = {"output_tokens": output_tokens}
-            
-            yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})}\n\n"
-            
-            # Send message_stop event
-            yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
-            
-            # Send final [DONE] marker to match Anthropic's behavior
-            yield "data: [DONE]\n\n"
+            yield f"event: content_block_stop\ndata: {json_dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+
+        # Send message_delta with stop reason and usage, including prompt-cache reads and writes
+        record_prompt_cache_usage(original_request.model, usage)
+        yield f"event: message_delta\ndata: {json_dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
+
+        # Send message_stop event
+        yield f"event: message_stop\ndata: {json_dumps({'type': 'message_stop'})}\n\n"
+
+        # Send final [DONE] marker to match Anthropic's behavior
+        yield "data: [DONE]\n\n"
     
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client disconnected mid-stream; closing the upstream below stops the generation
+        if not has_sent_stop_reason:
+            # What was left of max_tokens; the model would usually have stopped well before it
+            unused_budget = max(0, original_request.max_tokens - int(streamed_chars / RATE_LIMIT_CHARS_PER_TOKEN))
+            metrics.inc("ccp_streams_cancelled_total", model=original_request.model)
+            metrics.inc("ccp_cancelled_output_token_budget_unused_total", unused_budget, model=original_request.model)
+            logger.info(f"Client disconnected; cancelled {original_request.model} stream")
+        raise
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        error_message = f"Error in streaming: {str(e)}\n\nFull traceback:\n{error_traceback}"
-        logger.error(error_message)
-        
-        # Send error message_delta
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})}\n\n"
-        
-        # Send message_stop event
-        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+        if isinstance(e, ProxyError):
+            # Raised by the proxy itself (a missed deadline, a full queue); no traceback needed
+            logger.error(f"Error in streaming: {e}")
+        else:
+            import traceback
+            error_traceback = traceback.format_exc()
+            error_message = f"Error in streaming: {str(e)}\n\nFull traceback:\n{error_traceback}"
+            logger.error(error_message)
         
-        # Send final [DONE] marker
-        yield "data: [DONE]\n\n"
+        # The response has already started, so end it with Anthropic's error event, as the API does
+        yield f"event: error\ndata: {json_dumps(anthropic_error_body(anthropic_error_type(e), str(e)))}\n\n"
+    finally:
+        await close_upstream_stream(response_generator)
+
+def build_litellm_request(request: MessagesRequest) -> Dict[str, Any]:
+    """Build the LiteLLM request (with provider quirks applied) for request.model; credentials are added per attempt."""
+    # Convert Anthropic request to LiteLLM format, flattened for OpenAI models
+    litellm_request = convert_anthropic_to_litellm(request, flatten="openai" in request.model)
+    
+    # Retries are handled by the proxy (see with_retries); LiteLLM would otherwise default to 2
+    litellm_request["max_retries"] = 0
+
+    # OpenAI only reports usage (including cached prompt tokens) on streams when asked to
+    if litellm_request.get("stream") and litellm_request["model"].startswith("openai/"):
+        litellm_request["stream_options"] = {"include_usage": True}
+
+    return litellm_request
+
+async def complete_upstream(litellm_request: Dict[str, Any], first_token_timeout: Optional[float] = None):
+    """Run a non-streaming completion without blocking the event loop."""
+    if first_token_timeout:
+        # Without streaming, the first token only arrives with the whole response
+        try:
+            return await asyncio.wait_for(litellm.acompletion(**litellm_request), timeout=first_token_timeout)
+        except asyncio.TimeoutError:
+            raise FirstTokenTimeoutError(f"{litellm_request['model']} did not respond within {first_token_timeout:.1f}s")
+    return await litellm.acompletion(**litellm_request)
+
+class PrependedStream:
+    """A stream whose first chunk was already read, yielding it again before the rest."""
+
+    def __init__(self, first_chunk, response_generator):
+        self.first_chunk = first_chunk
+        self.response_generator = response_generator
+        self.started = False
+        # Keep LiteLLM's response metadata (such as the upstream headers) reachable
+        self._hidden_params = getattr(response_generator, "_hidden_params", {})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.started:
+            self.started = True
+            return self.first_chunk
+        try:
+            return await self.response_generator.__anext__()
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        await close_upstream_stream(self.response_generator)
+
+async def open_stream(litellm_request: Dict[str, Any], first_token_timeout: Optional[float] = None,
+                      wait_for_first_chunk: bool = False):
+    """Open an upstream stream, optionally waiting for its first chunk.
+
+    With a first-token deadline the first chunk is always awaited, so a stalled model can be abandoned.
+    """
+    if not first_token_timeout and not wait_for_first_chunk:
+        return await litellm.acompletion(**litellm_request)
+
+    timeout = first_token_timeout or None
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        response_generator = await asyncio.wait_for(litellm.acompletion(**litellm_request), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise FirstTokenTimeoutError(f"{litellm_request['model']} did not connect within {first_token_timeout:.1f}s")
+    try:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        first_chunk = await asyncio.wait_for(response_generator.__anext__(), timeout=remaining)
+    except StopAsyncIteration:
+        return response_generator
+    except asyncio.TimeoutError:
+        await close_upstream_stream(response_generator)
+        raise FirstTokenTimeoutError(f"{litellm_request['model']} sent no tokens within {first_token_timeout:.1f}s")
+    except BaseException:
+        await close_upstream_stream(response_generator)
+        raise
+    return PrependedStream(first_chunk, response_generator)
+
+def get_model_chain(original_model: str, routed_model: str) -> List[str]:
+    """Return the routed model followed by the fallbacks configured for its tier."""
+    if 'haiku' in original_model.lower():
+        chain = SMALL_MODEL_CHAIN
+    elif 'sonnet' in original_model.lower():
+        chain = BIG_MODEL_CHAIN
+    else:
+        return [routed_model]
+    return [routed_model] + [model for model in chain if model != routed_model]
+
+def should_fall_back(exc: BaseException) -> bool:
+    """Upstream failures, rate limits, stalls and saturation move on to the next model; client errors do not."""
+    return isinstance(exc, (OverloadedError, FirstTokenTimeoutError)) or is_retryable(exc)
+
+def classify_priority(request: MessagesRequest, original_model: str) -> str:
+    """Place a request in a priority class, so interactive turns are not queued behind background calls."""
+    requested = (request.metadata or {}).get("priority")
+    if requested in PRIORITY_CLASSES:
+        return requested
+    model = original_model.lower()
+    if "haiku" in model:
+        # Small side calls such as topic detection and title generation
+        return "normal" if request.tools else "background"
+    if "sonnet" in model or "opus" in model:
+        # Main-agent turns stream and carry the tool set
+        return "interactive" if request.stream or request.tools else "normal"
+    return "normal"
+
+async def call_upstream(request: MessagesRequest, models: List[str], wait_for_first_chunk: bool = False,
+                        prepared: Optional[Dict[str, Any]] = None, priority: str = "normal"):
+    """Send the request to each model in turn until one succeeds.
+
+    The request is re-converted for every candidate so provider-specific handling (such as
+    Gemini schema cleaning) matches the model actually called; prepared, if given, is the
+    already-built LiteLLM request for request.model. Returns the request as served, its
+    LiteLLM request, the LiteLLM response (or stream) and the admission ticket to release
+    once a stream is finished.
+    """
+    # Estimated once, and only once a key of some model in the chain reports a token budget
+    token_cost = None
+    for index, model in enumerate(models):
+        is_last = index == len(models) - 1
+        served_request = request if model == request.model else request.model_copy(update={"model": model})
+        if prepared is not None and model == request.model:
+            litellm_request = prepared
+        else:
+            litellm_request = build_litellm_request(served_request)
+        first_token_timeout = FALLBACK_TTFT_SECONDS if FALLBACK_TTFT_SECONDS > 0 and not is_last else None
+        if request.stream:
+            open_upstream = lambda attempt: open_stream(attempt, first_token_timeout, wait_for_first_chunk)
+        else:
+            open_upstream = lambda attempt: complete_upstream(attempt, first_token_timeout)
+        if token_cost is None and key_pools[get_provider(model)].paces_tokens():
+            token_cost = estimate_token_cost(served_request, litellm_request)
+        # Each attempt picks its own key, so a retry after a 429 moves to another key
+        # Non-streaming calls hold an upstream_semaphore slot, taken before the attempt is timed
+        semaphore = None if request.stream else upstream_semaphore
+        call = lambda: with_api_key(open_upstream, litellm_request, ticket, hold_until_released=request.stream,
+                                    token_cost=token_cost or 0, semaphore=semaphore)
+
+        try:
+            ticket = await admission.admit(model, priority)
+            try:
+                start_time = time.monotonic()
+                result = await with_circuit_breaker(lambda: with_retries(call, model), model)
+                first_token_latency.record(model, time.monotonic() - start_time)
+            except BaseException as e:
+                # A cancelled (such as a lost hedge) or timed-out attempt took at least this long; leaving it
+                # out would bias the hedge percentile low
+                if isinstance(e, (asyncio.CancelledError, asyncio.TimeoutError, FirstTokenTimeoutError, litellm.Timeout)):
+                    first_token_latency.record(model, time.monotonic() - start_time)
+                ticket.release()
+                raise
+            if not request.stream:
+                ticket.release()
+            return served_request, litellm_request, result, ticket
+        except Exception as e:
+            if is_last or not should_fall_back(e):
+                raise
+            reason = type(e).__name__ if isinstance(e, ProxyError) else str(get_status_code(e) or type(e).__name__)
+            metrics.inc("ccp_fallbacks_total", model=model, fallback=models[index + 1], reason=reason)
+            logger.warning(f"⚠️ {model} failed ({reason}); falling back to {models[index + 1]}")
+
+# --- Request Hedging ---
+# Opt-in: race a second upstream request when the first is slower than usual to start
+HEDGING_ENABLED = os.environ.get("HEDGING_ENABLED", "false").lower() == "true"
+# Hedge once a request is slower to start than this percentile of recent requests to the same model
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+# Hedge delay used until enough latency samples have been collected for a model
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "3"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+
+class LatencyTracker:
+    """Recent time-to-first-token samples per model."""
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, model: str, seconds: float):
+        self.samples.setdefault(model, deque(maxlen=self.size)).append(seconds)
+
+    def percentile(self, model: str, percentile: float) -> Optional[float]:
+        samples = sorted(self.samples.get(model, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+first_token_latency = LatencyTracker()
+
+def get_hedge_delay(model: str) -> float:
+    delay = first_token_latency.percentile(model, HEDGE_PERCENTILE)
+    if delay is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, delay)
+
+async def discard_attempt(task: asyncio.Future):
+    """Cancel an upstream attempt, or close the stream and slot it already holds."""
+    if not task.done():
+        task.cancel()
+    try:
+        _, _, result, ticket = await task
+    except BaseException:
+        return
+    ticket.release()
+    await close_upstream_stream(result)
+
+async def call_upstream_hedged(request: MessagesRequest, models: List[str], prepared: Optional[Dict[str, Any]] = None,
+                               priority: str = "normal"):
+    """Like call_upstream, but starts a second request if the first is slow to produce its first chunk.
+
+    The hedge goes to the next model in the chain, or to the same model if there is none.
+    Whichever request produces output first wins and the other is cancelled immediately.
+    """
+    primary_model = models[0]
+    metrics.inc("ccp_hedge_eligible_total", model=primary_model)
+    primary = asyncio.ensure_future(call_upstream(request, models, wait_for_first_chunk=True, prepared=prepared, priority=priority))
+    hedge = None
+    winner = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=get_hedge_delay(primary_model))
+        if done:
+            winner = primary
+            return primary.result()
+
+        hedge_models = models[1:] or models
+        metrics.inc("ccp_hedges_total", model=primary_model)
+        logger.info(f"Hedging slow request to {primary_model} with {hedge_models[0]}")
+        hedge = asyncio.ensure_future(call_upstream(request, hedge_models, wait_for_first_chunk=True, prepared=prepared, priority=priority))
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if winner is None and not task.cancelled() and task.exception() is None:
+                    winner = task
+            if winner is not None:
+                break
+        if winner is None:
+            # Both failed; report the primary's error
+            return primary.result()
+
+        metrics.inc("ccp_hedge_wins_total", model=primary_model, winner="hedge" if winner is hedge else "primary")
+        return winner.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and task is not winner:
+                await discard_attempt(task)
+
+# --- Deadlines ---
+# Per model tier ('small' for haiku, 'big' for everything else), in seconds; 0 disables a limit
+FIRST_TOKEN_TIMEOUT = {"small": 60.0, "big": 120.0}
+FIRST_TOKEN_TIMEOUT.update(parse_limit_map(os.environ.get("FIRST_TOKEN_TIMEOUT"), float))
+# Longest gap allowed between two chunks of a stream
+STREAM_IDLE_TIMEOUT = {"small": 30.0, "big": 60.0}
+STREAM_IDLE_TIMEOUT.update(parse_limit_map(os.environ.get("STREAM_IDLE_TIMEOUT"), float))
+# Total time allowed for a request, including the whole stream
+REQUEST_TIMEOUT = {"small": 300.0, "big": 600.0}
+REQUEST_TIMEOUT.update(parse_limit_map(os.environ.get("REQUEST_TIMEOUT"), float))
+
+class DeadlineExceededError(ProxyError):
+    """Raised when an upstream misses one of the request's deadlines."""
+    status_code = 504
+    error_type = "timeout_error"
+
+def get_model_tier(original_model: str) -> str:
+    return "small" if "haiku" in original_model.lower() else "big"
+
+class Deadlines:
+    """The absolute deadlines of one request, measured from when it arrived."""
+
+    def __init__(self, first_token: Optional[float], idle: Optional[float], total: Optional[float]):
+        self.start = time.monotonic()
+        self.first_token_at = self.start + first_token if first_token else None
+        self.idle = idle or None
+        self.total_at = self.start + total if total else None
+
+    def next_timeout(self, stage: str) -> Tuple[Optional[float], Optional[str]]:
+        """Return the seconds left before the nearest deadline for a stage, and which deadline it is.
+
+        stage is "first_token" (waiting for a stream's first chunk), "idle" (waiting for a
+        later chunk) or "total" (waiting for a whole response).
+        """
+        now = time.monotonic()
+        limits = []
+        if self.total_at is not None:
+            limits.append((self.total_at - now, "total"))
+        if stage == "first_token" and self.first_token_at is not None:
+            limits.append((self.first_token_at - now, "first_token"))
+        elif stage == "idle" and self.idle is not None:
+            limits.append((self.idle, "idle"))
+        if not limits:
+            return None, None
+        timeout, reason = min(limits)
+        return max(0.0, timeout), reason
+
+def get_deadlines(original_model: str, raw_request: Request) -> Deadlines:
+    """Build a request's deadlines from its model tier, capped by any deadline the client sent."""
+    tier = get_model_tier(original_model)
+    total = REQUEST_TIMEOUT.get(tier) or None
+    # x-ccp-deadline is seconds from now; Anthropic SDKs send their own timeout as x-stainless-timeout
+    for header in ("x-ccp-deadline", "x-stainless-timeout"):
+        value = raw_request.headers.get(header)
+        if value is None:
+            continue
+        try:
+            client_deadline = float(value)
+        except ValueError:
+            logger.warning(f"Ignoring invalid {header} header: {value!r}")
+            continue
+        if client_deadline > 0:
+            total = min(total, client_deadline) if total else client_deadline
+        break
+    return Deadlines(FIRST_TOKEN_TIMEOUT.get(tier), STREAM_IDLE_TIMEOUT.get(tier), total)
+
+def deadline_error(model: str, reason: str, deadlines: Deadlines) -> DeadlineExceededError:
+    metrics.inc("ccp_deadline_exceeded_total", model=model, deadline=reason)
+    elapsed = time.monotonic() - deadlines.start
+    messages = {
+        "first_token": f"{model} produced no output within {elapsed:.1f}s",
+        "idle": f"{model} stream stalled for {deadlines.idle:.1f}s",
+        "total": f"Request to {model} exceeded its {elapsed:.1f}s deadline",
+    }
+    return DeadlineExceededError(messages[reason])
+
+async def with_deadline(call: Awaitable, model: str, deadlines: Deadlines, stage: str):
+    """Await call within the request's deadlines for the given stage."""
+    timeout, reason = deadlines.next_timeout(stage)
+    try:
+        return await asyncio.wait_for(call, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise deadline_error(model, reason, deadlines)
+
+class DeadlineStream:
+    """Wraps an upstream stream, enforcing first-token, idle and total deadlines between chunks."""
+
+    def __init__(self, response_generator, model: str, deadlines: Deadlines):
+        self.response_generator = response_generator
+        self.model = model
+        self.deadlines = deadlines
+        self.received = False
+        self._hidden_params = getattr(response_generator, "_hidden_params", {})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        stage = "idle" if self.received else "first_token"
+        chunk = await with_deadline(self.response_generator.__anext__(), self.model, self.deadlines, stage)
+        self.received = True
+        return chunk
+
+    async def aclose(self):
+        await close_upstream_stream(self.response_generator)
+
+# --- Single-Flight Coalescing ---
+# Identical requests from the same caller arriving while one is already in flight share its upstream call
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+def message_digest(message: Dict[str, Any]) -> bytes:
+    """Hash one converted message canonically."""
+    return hashlib.sha256(json.dumps(message, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")).digest()
+
+def request_fingerprint(request: MessagesRequest, litellm_request: Dict[str, Any]) -> str:
+    """Hash a converted request canonically, ignoring per-attempt settings such as credentials.
+
+    Messages are hashed one at a time and their digests kept by the conversion cache, so a resent
+    history only hashes its new messages. Tools are hashed in their Anthropic form, which the
+    model (part of the hash) determines the translation of.
+    """
+    settings = {key: value for key, value in litellm_request.items()
+                if key not in ("api_key", "api_base", "client", "max_retries", "messages", "tools")}
+    hasher = hashlib.sha256(json.dumps(settings, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8"))
+    for tool in request.tools or ():
+        hasher.update(hashlib.sha256(tool.__pydantic_serializer__.to_json(tool)).digest())
+
+    messages = litellm_request["messages"]
+    model = litellm_request["model"]
+    digests = conversion_cache.message_digests(request, message_dialect("openai" in model, supports_cache_control(model)))
+    if digests is None:
+        digests = [message_digest(message) for message in messages]
+    else:
+        # The system prompt is converted outside the cache
+        digests = [message_digest(message) for message in messages[:len(messages) - len(digests)]] + digests
+    hasher.update(b"messages")
+    for digest in digests:
+        hasher.update(digest)
+    return hasher.hexdigest()
+
+class Flight:
+    """One shared upstream call and the number of clients waiting on it."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.task: Optional[asyncio.Future] = None
+        self.subscribers = 1
+        # Streams only: resolves once the upstream stream is open, then SSE events are buffered for replay
+        self.opened: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.events: List[str] = []
+        self.finished = False
+        self._changed = asyncio.Event()
+
+    def publish(self, event: str):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def replay(self):
+        """Yield every event of the stream from the start, then new ones as they are produced."""
+        index = 0
+        while True:
+            if index < len(self.events):
+                yield self.events[index]
+                index += 1
+            elif self.finished:
+                return
+            else:
+                await self._changed.wait()
+
+class SingleFlight:
+    """Runs each upstream call once for all identical requests in flight at the same time."""
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+
+    def _join(self, key: str, start: Callable[[Flight], Awaitable], stream: bool) -> Flight:
+        flight = self.flights.get(key)
+        if flight is not None:
+            flight.subscribers += 1
+            metrics.inc("ccp_upstream_calls_saved_total", stream=str(stream).lower())
+            return flight
+        flight = self.flights[key] = Flight(key)
+        flight.task = asyncio.ensure_future(start(flight))
+        flight.task.add_done_callback(lambda _: self._forget(flight))
+        return flight
+
+    def _forget(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def leave(self, flight: Flight):
+        """Drop one client; the shared call is cancelled once no client is left."""
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.task.done():
+            self._forget(flight)
+            flight.task.cancel()
+
+    async def complete(self, key: Optional[str], call: Callable[[], Awaitable]):
+        """Return call()'s result, sharing it with identical in-flight requests (key None never shares)."""
+        if key is None:
+            return await call()
+        flight = self._join(key, lambda _: call(), stream=False)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self.leave(flight)
+
+    async def stream(self, key: Optional[str], open_events: Callable[[], Awaitable]):
+        """Open an SSE stream once and fan its events out to every identical in-flight request.
+
+        open_events() returns (served_request, litellm_request, events). Errors raised while
+        opening reach every client as a normal error response; the stream itself is shared.
+        Returns the same tuple, with a per-client events generator.
+        """
+        if key is None:
+            return await open_events()
+
+        async def produce(flight: Flight):
+            try:
+                served_request, litellm_request, events = await open_events()
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    flight.opened.cancel()
+                    raise
+                flight.opened.set_exception(e)
+                return
+            flight.opened.set_result((served_request, litellm_request))
+            try:
+                async for event in events:
+                    flight.publish(event)
+            finally:
+                flight.finish()
+
+        flight = self._join(key, produce, stream=True)
+        try:
+            served_request, litellm_request = await asyncio.shield(flight.opened)
+        except BaseException:
+            self.leave(flight)
+            raise
+
+        async def follow():
+            try:
+                async for event in flight.replay():
+                    yield event
+            finally:
+                self.leave(flight)
+
+        return served_request, litellm_request, follow()
+
+single_flight = SingleFlight()
+metrics.gauge("ccp_single_flight_in_flight", lambda: [({}, len(single_flight.flights))])
+
+# --- Response Cache ---
+# Memory budget for cached responses (0 disables the cache)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Seconds a cached response stays valid
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+# Cache deterministic (temperature 0) requests automatically; others only with 'x-ccp-cache: true'
+RESPONSE_CACHE_DETERMINISTIC = os.environ.get("RESPONSE_CACHE_DETERMINISTIC", "true").lower() == "true"
+# Also record finished SSE streams of cacheable streaming requests and replay them on later hits
+STREAM_CACHE_ENABLED = os.environ.get("STREAM_CACHE_ENABLED", "false").lower() == "true"
+# How recorded streams are replayed: 'instant' or 'original' (with the recorded pacing)
+STREAM_CACHE_REPLAY = os.environ.get("STREAM_CACHE_REPLAY", "instant").lower()
+# Opt-in persistent tier under the memory cache, shared by all workers: a SQLite file (unset keeps
+# responses in memory only) and its size cap; see 'ccp cache'
+RESPONSE_CACHE_DISK_PATH = os.environ.get("RESPONSE_CACHE_DISK_PATH", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+class ResponseCache:
+    """An in-memory LRU cache of serialized responses with a TTL and a total size budget.
+
+    With a disk tier, entries are also written to it and memory misses fall through to it,
+    so responses survive restarts and are shared by every worker.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, disk: Optional[DiskCache] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = disk
+        self.size = 0
+        # key -> (expires_at, served model, body), least recently used first
+        self.entries: "OrderedDict[str, Tuple[float, str, bytes]]" = OrderedDict()
+
+    async def get(self, key: str, stream: bool = False) -> Optional[Tuple[str, bytes]]:
+        """Return (served model, body) for a fresh entry, or None."""
+        labels = {"stream": str(stream).lower()}
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key, "expired")
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+            metrics.inc("ccp_response_cache_requests_total", result="hit", tier="memory", **labels)
+            return entry[1], entry[2]
+        if self.disk is not None:
+            try:
+                found = await asyncio.to_thread(self.disk.get, key)
+            except Exception as e:
+                logger.warning(f"Disk cache read failed: {e}")
+                found = None
+            if found is not None:
+                model, body, expires_at = found
+                self._put_memory(key, model, body, time.monotonic() + expires_at - time.time())
+                metrics.inc("ccp_response_cache_requests_total", result="hit", tier="disk", **labels)
+                return model, body
+        metrics.inc("ccp_response_cache_requests_total", result="miss", tier="none", **labels)
+        return None
+
+    async def put(self, key: str, model: str, body: bytes):
+        self._put_memory(key, model, body, time.monotonic() + self.ttl)
+        if self.disk is not None:
+            try:
+                evicted = await asyncio.to_thread(self.disk.put, key, model, body, time.time() + self.ttl)
+            except Exception as e:
+                logger.warning(f"Disk cache write failed: {e}")
+                return
+            if evicted:
+                metrics.inc("ccp_response_cache_evictions_total", evicted, reason="disk")
+
+    def _put_memory(self, key: str, model: str, body: bytes, expires_at: float):
+        # A single entry may use at most an eighth of the budget, so one response cannot flush the cache
+        if len(body) > self.max_bytes // 8:
+            return
+        if key in self.entries:
+            self._remove(key, None)
+        self.entries[key] = (expires_at, model, body)
+        self.size += len(body)
+        while self.size > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)), "size")
+
+    def _remove(self, key: str, reason: Optional[str]):
+        _, _, body = self.entries.pop(key)
+        self.size -= len(body)
+        if reason:
+            metrics.inc("ccp_response_cache_evictions_total", reason=reason)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes, "ttl_seconds": self.ttl}
+        if self.disk is not None:
+            stats["disk"] = {"path": os.path.abspath(self.disk.path), "max_bytes": self.disk.max_bytes}
+        return stats
+
+def open_disk_cache() -> Optional[DiskCache]:
+    if not RESPONSE_CACHE_DISK_PATH or RESPONSE_CACHE_MAX_BYTES <= 0 or RESPONSE_CACHE_DISK_MAX_BYTES <= 0:
+        return None
+    try:
+        return DiskCache(RESPONSE_CACHE_DISK_PATH, RESPONSE_CACHE_DISK_MAX_BYTES)
+    except Exception as e:
+        logger.warning(f"Disk cache at {RESPONSE_CACHE_DISK_PATH} unavailable, caching in memory only: {e}")
+        return None
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, open_disk_cache())
+metrics.gauge("ccp_response_cache_bytes", lambda: [({}, response_cache.size)])
+metrics.gauge("ccp_response_cache_entries", lambda: [({}, len(response_cache.entries))])
+
+def is_cacheable(request: MessagesRequest, raw_request: Request) -> bool:
+    """Whether a request's response may be served from, and stored in, the response cache."""
+    if RESPONSE_CACHE_MAX_BYTES <= 0:
+        return False
+    requested = raw_request.headers.get("x-ccp-cache", "").lower()
+    if requested in ("0", "false", "no", "off", "no-store"):
+        return False
+    if requested in ("1", "true", "yes", "on"):
+        return True
+    if request.stream and not STREAM_CACHE_ENABLED:
+        return False
+    return RESPONSE_CACHE_DETERMINISTIC and request.temperature == 0
+
+def response_cache_key(fingerprint: str, request: MessagesRequest, raw_request: Request) -> str:
+    """Response cache and single-flight key for a request: its fingerprint, scoped to the caller.
+
+    The caller is the client's API key (hashed) and metadata.user_id, so clients sharing a proxy
+    are never served each other's cached completions, nor attached to each other's upstream calls.
+    """
+    return f"{fingerprint}:{request._caller or caller_hash(request, raw_request)}"
+
+async def record_stream(events, key: str, model: str):
+    """Pass SSE events through, caching the timed transcript only if the stream completes cleanly."""
+    start = time.monotonic()
+    transcript = []
+    completed = failed = False
+    try:
+        async for event in events:
+            transcript.append((round(time.monotonic() - start, 3), event))
+            if event.startswith("event: error"):
+                failed = True
+            elif event.startswith("event: message_stop"):
+                completed = True
+            yield event
+    finally:
+        await close_upstream_stream(events)
+    # Not reached when the client disconnects; a partial transcript is never stored
+    if completed and not failed:
+        await response_cache.put(key, model, json.dumps(transcript, separators=(",", ":")).encode("utf-8"))
+
+async def replay_stream(body: bytes, pacing: str):
+    """Yield a recorded SSE transcript, at once or spaced out as it was originally produced."""
+    start = time.monotonic()
+    for offset, event in json_loads(body):
+        if pacing == "original":
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield event
 
 @app.post("/v1/messages")
 async def create_message(
@@ -1090,11 +3419,8 @@ async def create_message(
     raw_request: Request
 ):
     try:
-        # print the body here
-        body = await raw_request.body()
-    
-        # Parse the raw body as JSON since it's bytes
-        body_json = json.loads(body.decode('utf-8'))
+        # FastAPI has already parsed the body (see JSONBackendRequest); reuse it
+        body_json = await raw_request.json()
         original_model = body_json.get("model", "unknown")
         
         # Get the display name for logging, just the model name without provider prefix
@@ -1111,166 +3437,67 @@ async def create_message(
         
         logger.debug(f"📊 PROCESSING REQUEST: Model={request.model}, Stream={request.stream}")
         
-        # Convert Anthropic request to LiteLLM format
-        litellm_request = convert_anthropic_to_litellm(request)
-        
-        # Determine which API key to use based on the model
-        if request.model.startswith("openai/"):
-            litellm_request["api_key"] = OPENAI_API_KEY
-            logger.debug(f"Using OpenAI API key for model: {request.model}")
-        elif request.model.startswith("gemini/"):
-            litellm_request["api_key"] = GEMINI_API_KEY
-            logger.debug(f"Using Gemini API key for model: {request.model}")
-        else:
-            litellm_request["api_key"] = ANTHROPIC_API_KEY
-            logger.debug(f"Using Anthropic API key for model: {request.model}")
-        
-        # For OpenAI models - modify request format to work with limitations
-        if "openai" in litellm_request["model"] and "messages" in litellm_request:
-            logger.debug(f"Processing OpenAI model request: {litellm_request['model']}")
-            
-            # For OpenAI models, we need to convert content blocks to simple strings
-            # and handle other requirements
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Special case - handle message content directly when it's a list of tool_result
-                # This is a specific case we're seeing in the error
-                if "content" in msg and isinstance(msg["content"], list):
-                    is_only_tool_result = True
-                    for block in msg["content"]:
-                        if not isinstance(block, dict) or block.get("type") != "tool_result":
-                            is_only_tool_result = False
-                            break
-                    
-                    if is_only_tool_result and len(msg["content"]) > 0:
-                        logger.warning(f"Found message with only tool_result content - special handling required")
-                        # Extract the content from all tool_result blocks
-                        all_text = ""
-                        for block in msg["content"]:
-                            all_text += "Tool Result:\n"
-                            result_content = block.get("content", [])
-                            
-                            # Handle different formats of content
-                            if isinstance(result_content, list):
-                                for item in result_content:
-                                    if isinstance(item, dict) and item.get("type") == "text":
-                                        all_text += item.get("text", "") + "\n"
-                                    elif isinstance(item, dict):
-                                        # Fall back to string representation of any dict
-                                        try:
-                                            item_text = item.get("text", json.dumps(item))
-                                            all_text += item_text + "\n"
-                                        except:
-                                            all_text += str(item) + "\n"
-                            elif isinstance(result_content, str):
-                                all_text += result_content + "\n"
-                            else:
-                                try:
-                                    all_text += json.dumps(result_content) + "\n"
-                                except:
-                                    all_text += str(result_content) + "\n"
-                        
-                        # Replace the list with extracted text
-                        litellm_request["messages"][i]["content"] = all_text.strip() or "..."
-                        logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
-                        continue  # Skip normal processing for this message
-                
-                # 1. Handle content field - normal case
-                if "content" in msg:
-                    # Check if content is a list (content blocks)
-                    if isinstance(msg["content"], list):
-                        # Convert complex content blocks to simple string
-                        text_content = ""
-                        for block in msg["content"]:
-                            if isinstance(block, dict):
-                                # Handle different content block types
-                                if block.get("type") == "text":
-                                    text_content += block.get("text", "") + "\n"
-                                
-                                # Handle tool_result content blocks - extract nested text
-                                elif block.get("type") == "tool_result":
-                                    tool_id = block.get("tool_use_id", "unknown")
-                                    text_content += f"[Tool Result ID: {tool_id}]\n"
-                                    
-                                    # Extract text from the tool_result content
-                                    result_content = block.get("content", [])
-                                    if isinstance(result_content, list):
-                                        for item in result_content:
-                                            if isinstance(item, dict) and item.get("type") == "text":
-                                                text_content += item.get("text", "") + "\n"
-                                            elif isinstance(item, dict):
-                                                # Handle any dict by trying to extract text or convert to JSON
-                                                if "text" in item:
-                                                    text_content += item.get("text", "") + "\n"
-                                                else:
-                                                    try:
-                                                        text_content += json.dumps(item) + "\n"
-                                                    except:
-                                                        text_content += str(item) + "\n"
-                                    elif isinstance(result_content, dict):
-                                        # Handle dictionary content
-                                        if result_content.get("type") == "text":
-                                            text_content += result_content.get("text", "") + "\n"
-                                        else:
-                                            try:
-                                                text_content += json.dumps(result_content) + "\n"
-                                            except:
-                                                text_content += str(result_content) + "\n"
-                                    elif isinstance(result_content, str):
-                                        text_content += result_content + "\n"
-                                    else:
-                                        try:
-                                            text_content += json.dumps(result_content) + "\n"
-                                        except:
-                                            text_content += str(result_content) + "\n"
-                                
-                                # Handle tool_use content blocks
-                                elif block.get("type") == "tool_use":
-                                    tool_name = block.get("name", "unknown")
-                                    tool_id = block.get("id", "unknown")
-                                    tool_input = json.dumps(block.get("input", {}))
-                                    text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
-                                
-                                # Handle image content blocks
-                                elif block.get("type") == "image":
-                                    text_content += "[Image content - not displayed in text format]\n"
-                        
-                        # Make sure content is never empty for OpenAI models
-                        if not text_content.strip():
-                            text_content = "..."
-                        
-                        litellm_request["messages"][i]["content"] = text_content.strip()
-                    # Also check for None or empty string content
-                    elif msg["content"] is None:
-                        litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
-                
-                # 2. Remove any fields OpenAI doesn't support in messages
-                for key in list(msg.keys()):
-                    if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
-                        logger.warning(f"Removing unsupported field from message: {key}")
-                        del msg[key]
-            
-            # 3. Final validation - check for any remaining invalid values and dump full message details
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Log the message format for debugging
-                logger.debug(f"Message {i} format check - role: {msg.get('role')}, content type: {type(msg.get('content'))}")
-                
-                # If content is still a list or None, replace with placeholder
-                if isinstance(msg.get("content"), list):
-                    logger.warning(f"CRITICAL: Message {i} still has list content after processing: {json.dumps(msg.get('content'))}")
-                    # Last resort - stringify the entire content as JSON
-                    litellm_request["messages"][i]["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
-                elif msg.get("content") is None:
-                    logger.warning(f"Message {i} has None content - replacing with placeholder")
-                    litellm_request["messages"][i]["content"] = "..." # Fallback placeholder
-        
-        # Only log basic info about the request, not the full details
-        logger.debug(f"Request for model: {litellm_request.get('model')}, stream: {litellm_request.get('stream', False)}")
-        
+        # The routed model, then any fallbacks configured for its tier
+        models = get_model_chain(original_model, request.model)
+        upstream = call_upstream_hedged if HEDGING_ENABLED else call_upstream
+        num_tools = len(request.tools) if request.tools else 0
+        priority = classify_priority(request, original_model)
+        metrics.inc("ccp_requests_total", priority=priority)
+        deadlines = get_deadlines(original_model, raw_request)
+
+        # Identical requests already in flight share one upstream call; repeated deterministic ones are cached
+        request._caller = caller_hash(request, raw_request)
+        prepared = build_litellm_request(request)
+        session_id = get_session_id(request, raw_request) if PREFIX_DIAGNOSTICS else None
+        if session_id:
+            prefix_tracker.observe(session_id, prepared)
+        cacheable = is_cacheable(request, raw_request)
+        fingerprint = request_fingerprint(request, prepared) if SINGLE_FLIGHT_ENABLED or cacheable else None
+        caller_key = response_cache_key(fingerprint, request, raw_request) if fingerprint else None
+        flight_key = caller_key if SINGLE_FLIGHT_ENABLED else None
+        cache_key = caller_key if cacheable else None
+
         # Handle streaming mode
         if request.stream:
-            # Use LiteLLM for streaming
-            num_tools = len(request.tools) if request.tools else 0
+            # Headers, message_start and ping go out at once; the upstream is connected inside the
+            # stream, so errors from here on reach the client as Anthropic error events.
+            # The admission slot is held for the whole stream
+            async def open_upstream():
+                served_request, _, response_generator, ticket = await with_deadline(
+                    upstream(request, models, prepared=prepared, priority=priority), request.model, deadlines, "first_token")
+                if served_request.model != request.model:
+                    logger.info(f"Streaming from fallback model {served_request.model}")
+                return DeadlineStream(response_generator, served_request.model, deadlines), ticket
+
+            if cacheable:
+                cached = await response_cache.get(cache_key, stream=True)
+                if cached is not None:
+                    log_request_beautifully(
+                        "POST",
+                        raw_request.url.path,
+                        display_model,
+                        prepared.get('model'),
+                        len(prepared['messages']),
+                        num_tools,
+                        200
+                    )
+                    pacing = raw_request.headers.get("x-ccp-replay", STREAM_CACHE_REPLAY).lower()
+                    return ClosingStreamingResponse(
+                        replay_stream(cached[1], pacing),
+                        media_type="text/event-stream",
+                        headers={"x-ccp-cache": "hit"},
+                    )
+
+            async def open_events():
+                events = handle_streaming(LazyUpstreamStream(open_upstream), request)
+                if cacheable:
+                    events = record_stream(events, cache_key, request.model)
+                return request, prepared, events
+
+            served_request, litellm_request, events = await single_flight.stream(flight_key, open_events)
             
+            # Only log basic info about the request, not the full details
+            logger.debug(f"Request for model: {litellm_request.get('model')}, stream: {litellm_request.get('stream', False)}")
             log_request_beautifully(
                 "POST", 
                 raw_request.url.path, 
@@ -1280,16 +3507,47 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            # Ensure we use the async version for streaming
-            response_generator = await litellm.acompletion(**litellm_request)
             
-            return StreamingResponse(
-                handle_streaming(response_generator, request),
-                media_type="text/event-stream"
-            )
+            headers = {"x-ccp-cache": "miss"} if cacheable else None
+            return ClosingStreamingResponse(events, media_type="text/event-stream", headers=headers)
         else:
             # Use LiteLLM for regular completion
-            num_tools = len(request.tools) if request.tools else 0
+            start_time = time.time()
+            headers = {}
+
+            if cacheable:
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    served_model, body = cached
+                    log_request_beautifully(
+                        "POST",
+                        raw_request.url.path,
+                        display_model,
+                        prepared.get('model'),
+                        len(prepared['messages']),
+                        num_tools,
+                        200
+                    )
+                    return Response(
+                        content=body,
+                        media_type="application/json",
+                        headers={"x-ccp-served-model": served_model, "x-ccp-cache": "hit"},
+                    )
+                headers["x-ccp-cache"] = "miss"
+
+            async def complete():
+                served_request, litellm_request, litellm_response, _ = await upstream(request, models, prepared=prepared, priority=priority)
+                # Convert LiteLLM response to Anthropic format; its model is the one that served it
+                anthropic_response = convert_litellm_to_anthropic(litellm_response, served_request)
+                # Serialized once, for the client and the cache (and any requests sharing this call)
+                body = dump_model(anthropic_response)
+                if cacheable:
+                    await response_cache.put(cache_key, served_request.model, body)
+                return served_request, litellm_request, body
+
+            served_request, litellm_request, body = await with_deadline(
+                single_flight.complete(flight_key, complete), request.model, deadlines, "total")
+            logger.debug(f"✅ RESPONSE RECEIVED: Model={litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
             
             log_request_beautifully(
                 "POST", 
@@ -1300,15 +3558,14 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            start_time = time.time()
-            litellm_response = litellm.completion(**litellm_request)
-            logger.debug(f"✅ RESPONSE RECEIVED: Model={litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
             
-            # Convert LiteLLM response to Anthropic format
-            anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
+            headers["x-ccp-served-model"] = served_request.model
             
-            return anthropic_response
+            return Response(content=body, media_type="application/json", headers=headers)
                 
+    except ProxyError:
+        # Already in Anthropic's error format
+        raise
     except Exception as e:
         import traceback
         error_traceback = traceback.format_exc()
@@ -1377,17 +3634,17 @@ async def count_tokens(
             clean_model = clean_model[len("openai/"):]
         
         # Convert the messages to a format LiteLLM can understand
-        converted_request = convert_anthropic_to_litellm(
-            MessagesRequest(
-                model=request.model,
-                max_tokens=100,  # Arbitrary value not used for token counting
-                messages=request.messages,
-                system=request.system,
-                tools=request.tools,
-                tool_choice=request.tool_choice,
-                thinking=request.thinking
-            )
+        messages_request = MessagesRequest(
+            model=request.model,
+            max_tokens=100,  # Arbitrary value not used for token counting
+            messages=request.messages,
+            system=request.system,
+            tools=request.tools,
+            tool_choice=request.tool_choice,
+            thinking=request.thinking
         )
+        messages_request._caller = caller_hash(messages_request, raw_request)
+        converted_request = convert_anthropic_to_litellm(messages_request)
         
         # Use LiteLLM's token_counter function
         try:
@@ -1427,6 +3684,28 @@ async def count_tokens(
         logger.error(f"Error counting tokens: {str(e)}\n{error_traceback}")
         raise HTTPException(status_code=500, detail=f"Error counting tokens: {str(e)}")
 
+@app.get("/v1/status")
+async def get_status():
+    """Expose proxy runtime state, such as upstream connection pool usage."""
+    return {
+        # Everything below is this worker's own state; with several workers, each answers for itself
+        "worker": {"pid": os.getpid(), "workers": WORKER_COUNT},
+        "upstream_pools": upstream_pool.stats(),
+        "admission": admission.stats(),
+        "circuit_breakers": [breaker.stats() for breaker in circuit_breakers.values()],
+        "api_keys": [key.stats() for pool in key_pools.values() for key in pool.keys],
+        "response_cache": response_cache.stats(),
+        "conversion_cache": conversion_cache.stats(),
+        "tool_cache": tool_cache.stats(),
+        "json_backend": JSON_ENGINE,
+        "prompt_prefix": {"canonical": CANONICAL_REQUESTS, "sessions": prefix_tracker.last} if PREFIX_DIAGNOSTICS else {"canonical": CANONICAL_REQUESTS},
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose proxy metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render())
+
 @app.get("/")
 async def root():
     return {"message": "Claude Code Plus: An Anthropic client proxy for OpenAI & Gemini models."}